@@ -3,6 +3,7 @@ from sys import stderr
 
 from fastapi import FastAPI
 
+from src.db import create_csv_cache_indexes
 from src.router import router as calculation_router
 
 
@@ -35,3 +36,8 @@ logger.addHandler(stdout_handler)
 app = FastAPI(title="Random generator")
 
 app.include_router(calculation_router)
+
+
+@app.on_event("startup")
+async def create_indexes():
+    await create_csv_cache_indexes()
@@ -1,128 +1,95 @@
-from .db import aggregate_cached_csv, read_all_used_buids_in_cached_csv
-from .static.db_search_models import CommissionAsset, OrderType
-
-
-def calculate_sum_for_users(bot_internal_id: int):
-    data = {
-        int(x): {
-            "sum_results_before_user_used_the_bot_for_30_days": {
-                "spot": {},
-                "futures": {}
-            },
-            "sum_results_after_user_used_the_bot_for_30_days": {
-                "spot": {},
-                "futures": {}
-            }
-        } for x in read_all_used_buids_in_cached_csv()
+import json
+
+from csv_common.const import CommissionAsset, CsvColumns
+from csv_common.parsing import ORDER_TYPE_KEYS
+
+from .db import aggregate_cached_csv_by_friend, read_csv_summary, read_dataset_state, replace_csv_summary, \
+    set_csv_summary_version
+
+
+# USDT is summed by its USDT value, other assets by the amount of the coin itself
+COMMISSION_ASSET_KEYS = {
+    CommissionAsset.usdt.value: ("usdt", "USDT_COMMISSION_SUM"),
+    CommissionAsset.busd.value: ("busd", "COIN_COMMISSION_SUM"),
+    CommissionAsset.bnb.value: ("bnb", "COIN_COMMISSION_SUM"),
+}
+
+
+def _empty_user_sums():
+    return {
+        "sum_results_before_user_used_the_bot_for_30_days": {
+            "spot": {},
+            "futures": {}
+        },
+        "sum_results_after_user_used_the_bot_for_30_days": {
+            "spot": {},
+            "futures": {}
+        }
     }
 
-    for x in aggregate_cached_csv(
-        bot_internal_id,
-        OrderType.spot.value,
-        CommissionAsset.usdt.value,
-        "lt"
-    ):
-        data[
-            x.get("_id")
-        ]["sum_results_before_user_used_the_bot_for_30_days"]["spot"]["usdt"] = x.get("USDT_COMMISSION_SUM")
-    for x in aggregate_cached_csv(
-        bot_internal_id,
-        OrderType.spot.value,
-        CommissionAsset.busd.value,
-        "lt"
-    ):
-        data[
-            x.get("_id")
-        ]["sum_results_before_user_used_the_bot_for_30_days"]["spot"]["busd"] = x.get("COIN_COMMISSION_SUM")
-    for x in aggregate_cached_csv(
-        bot_internal_id,
-        OrderType.spot.value,
-        CommissionAsset.bnb.value,
-        "lt"
-    ):
-        data[
-            x.get("_id")
-        ]["sum_results_after_user_used_the_bot_for_30_days"]["spot"]["bnb"] = x.get("COIN_COMMISSION_SUM")
-    for x in aggregate_cached_csv(
-        bot_internal_id,
-        OrderType.spot.value,
-        CommissionAsset.usdt.value,
-        "gte"
-    ):
-        data[
-            x.get("_id")
-        ]["sum_results_after_user_used_the_bot_for_30_days"]["spot"]["usdt"] = x.get("USDT_COMMISSION_SUM")
-    for x in aggregate_cached_csv(
-        bot_internal_id,
-        OrderType.spot.value,
-        CommissionAsset.busd.value,
-        "gte"
-    ):
-        data[
-            x.get("_id")
-        ]["sum_results_after_user_used_the_bot_for_30_days"]["spot"]["busd"] = x.get("COIN_COMMISSION_SUM")
-    for x in aggregate_cached_csv(
-        bot_internal_id,
-        OrderType.spot.value,
-        CommissionAsset.bnb.value,
-        "gte"
-    ):
-        data[
-            x.get("_id")
-        ]["sum_results_after_user_used_the_bot_for_30_days"]["spot"]["bnb"] = x.get("COIN_COMMISSION_SUM")
-    for x in aggregate_cached_csv(
-        bot_internal_id,
-        OrderType.usdt_futures.value,
-        CommissionAsset.usdt.value,
-        "lt"
-    ):
-        data[
-            x.get("_id")
-        ]["sum_results_before_user_used_the_bot_for_30_days"]["futures"]["usdt"] = x.get("USDT_COMMISSION_SUM")
-    for x in aggregate_cached_csv(
-        bot_internal_id,
-        OrderType.usdt_futures.value,
-        CommissionAsset.busd.value,
-        "lt"
-    ):
-        data[
-            x.get("_id")
-        ]["sum_results_before_user_used_the_bot_for_30_days"]["futures"]["busd"] = x.get("COIN_COMMISSION_SUM")
-    for x in aggregate_cached_csv(
-        bot_internal_id,
-        OrderType.usdt_futures.value,
-        CommissionAsset.bnb.value,
-        "lt"
-    ):
-        data[
-            x.get("_id")
-        ]["sum_results_before_user_used_the_bot_for_30_days"]["futures"]["bnb"] = x.get("COIN_COMMISSION_SUM")
-    for x in aggregate_cached_csv(
-        bot_internal_id,
-        OrderType.usdt_futures.value,
-        CommissionAsset.usdt.value,
-        "gte"
-    ):
-        data[
-            x.get("_id")
-        ]["sum_results_after_user_used_the_bot_for_30_days"]["futures"]["usdt"] = x.get("USDT_COMMISSION_SUM")
-    for x in aggregate_cached_csv(
-        bot_internal_id,
-        OrderType.usdt_futures.value,
-        CommissionAsset.busd.value,
-        "gte"
-    ):
-        data[
-            x.get("_id")
-        ]["sum_results_after_user_used_the_bot_for_30_days"]["futures"]["busd"] = x.get("COIN_COMMISSION_SUM")
-    for x in aggregate_cached_csv(
-        bot_internal_id,
-        OrderType.usdt_futures.value,
-        CommissionAsset.bnb.value,
-        "gte"
-    ):
-        data[
-            x.get("_id")
-        ]["sum_results_after_user_used_the_bot_for_30_days"]["futures"]["bnb"] = x.get("COIN_COMMISSION_SUM")
+
+async def calculate_sum_for_users(bot_internal_id: int):
+    data = {}
+
+    async for x in aggregate_cached_csv_by_friend(bot_internal_id):
+        group = x.get("_id")
+        user_sums = data.setdefault(int(group.get("friend_id")), _empty_user_sums())
+
+        order_type = ORDER_TYPE_KEYS.get(group.get("order_type"))
+        asset = COMMISSION_ASSET_KEYS.get(group.get("commission_asset"))
+        if order_type is None or asset is None:
+            continue
+        asset_key, sum_field = asset
+
+        period = "sum_results_after_user_used_the_bot_for_30_days" if group.get("is_after_trial") is True \
+            else "sum_results_before_user_used_the_bot_for_30_days"
+        user_sums[period][order_type][asset_key] = x.get(sum_field)
 
     return data
+
+
+async def read_sum_for_users_from_summary(bot_internal_id: int):
+    """Same as calculate_sum_for_users, but from csv_summary, that has one document per friend"""
+    data = {}
+
+    async for x in read_csv_summary(bot_internal_id):
+        user_sums = data.setdefault(int(x.pop(CsvColumns.friend_id_spot.value)), _empty_user_sums())
+        for period, order_types in x.items():
+            for order_type, sums in order_types.items():
+                user_sums[period][order_type].update(sums)
+
+    return data
+
+
+class DatasetIsNotReady(Exception):
+    pass
+
+
+# Bot internal id -> (dataset version, calculation results rendered to json)
+calculation_results_cache: dict[int, tuple[int, bytes]] = {}
+
+
+async def read_calculation_results(bot_internal_id: int) -> tuple[bytes, bool]:
+    """Returns json with the results of calculate_sum_for_users, and whether it was taken from the cache.
+    Results are calculated again only after the dataset version of the bot has changed.
+    They are read from csv_summary, if it's complete, otherwise the raw rows are summed and the summary is rewritten.
+    Raises DatasetIsNotReady while an upload is being written"""
+    dataset_version, summary_version, ingest_state = await read_dataset_state(bot_internal_id)
+    if ingest_state is not None:
+        raise DatasetIsNotReady("Csv upload of the bot is {:}".format(ingest_state))
+
+    cached_results = calculation_results_cache.get(bot_internal_id)
+    if cached_results is not None and cached_results[0] == dataset_version:
+        return cached_results[1], True
+
+    if summary_version == dataset_version:
+        sums_for_users = await read_sum_for_users_from_summary(bot_internal_id)
+    else:
+        sums_for_users = await calculate_sum_for_users(bot_internal_id)
+        await replace_csv_summary(bot_internal_id, sums_for_users)
+        await set_csv_summary_version(bot_internal_id, dataset_version)
+
+    results = json.dumps(sums_for_users).encode()
+    calculation_results_cache[bot_internal_id] = (dataset_version, results)
+
+    return results, False
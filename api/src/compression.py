@@ -0,0 +1,61 @@
+import asyncio
+import zipfile
+from typing import BinaryIO
+
+import zstandard
+
+from csv_common.compression import GzipDecompressor, detect_compression, raise_if_truncated
+
+from .static.const import CsvIngestSettings
+
+
+class _PlainDecompressor:
+    eof = True
+
+    @staticmethod
+    def decompress(data: bytes) -> bytes:
+        return data
+
+
+async def _file_blocks(file: BinaryIO):
+    """Yields the file block by block, decompressed if it's an archive"""
+    compression = detect_compression(await asyncio.to_thread(file.read, 4))
+    await asyncio.to_thread(file.seek, 0)
+
+    if compression == "zip":
+        with zipfile.ZipFile(file) as archive:
+            csv_files = [name for name in archive.namelist() if name.endswith(".csv")]
+            if not csv_files:
+                raise Exception("No .csv in the archive")
+            with archive.open(csv_files[0]) as f:
+                while block := await asyncio.to_thread(f.read, CsvIngestSettings.read_size.value):
+                    yield block
+    else:
+        if compression == "gzip":
+            decompressor = GzipDecompressor()
+        elif compression == "zstd":
+            decompressor = zstandard.ZstdDecompressor().decompressobj()
+        else:
+            decompressor = _PlainDecompressor()
+
+        while block := await asyncio.to_thread(file.read, CsvIngestSettings.read_size.value):
+            yield await asyncio.to_thread(decompressor.decompress, block)
+
+        raise_if_truncated(decompressor)
+
+
+async def csv_chunks_from_file(file: BinaryIO, chunk_size: int = CsvIngestSettings.chunk_size.value):
+    """Reads the .csv, .csv.gz, .zip or .zst file in a stream and yields its lines in chunks of about chunk_size bytes,
+    that end with a line break. The decompressed file is never written to the disk and is never in memory as a whole"""
+    buffer = b""
+    async for block in _file_blocks(file):
+        buffer += block
+        while True:
+            line_break = buffer.find(b"\n", chunk_size - 1)
+            if line_break == -1:
+                break
+            yield buffer[:line_break + 1]
+            buffer = buffer[line_break + 1:]
+
+    if buffer:
+        yield buffer
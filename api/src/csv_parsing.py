@@ -0,0 +1,95 @@
+import asyncio
+import hashlib
+import io
+import logging
+import math
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+from datetime import datetime
+from functools import partial
+from typing import BinaryIO
+
+from csv_common.const import CsvColumns
+from csv_common.parsing import COMMISSION_ASSET_COLUMNS, ORDER_TYPE_KEYS, parse_csv_row
+
+from .compression import csv_chunks_from_file
+
+
+def row_fingerprint(document: dict) -> str:
+    """Identifies a row between uploads by friend, commission time, asset, order type and amounts.
+    Identical rows have the same fingerprint, so they have to be compared by counts"""
+    key = "|".join([
+        str(document.get(CsvColumns.friend_id_spot.value)),
+        document.get(CsvColumns.commission_time.value).isoformat(),
+        str(document.get(CsvColumns.commission_asset.value)),
+        str(document.get(CsvColumns.order_type.value)),
+        repr(document.get(CsvColumns.coin_commission_earned.value)),
+        repr(document.get(CsvColumns.usdt_commission_earned.value)),
+    ])
+    return hashlib.blake2b(key.encode(), digest_size=16).hexdigest()
+
+
+def sum_documents_by_friend(documents: list[dict]) -> dict[int, dict[str, float]]:
+    """Sums commissions of the documents the same way calculate_sum_for_users does.
+    Returns friend id -> {csv_summary path of the sum: sum}, friends without tracked commissions get no paths"""
+    values: dict[int, dict[str, list[float]]] = {}
+    for document in documents:
+        friend_values = values.setdefault(document.get(CsvColumns.friend_id_spot.value), {})
+
+        order_type = ORDER_TYPE_KEYS.get(document.get(CsvColumns.order_type.value))
+        asset = COMMISSION_ASSET_COLUMNS.get(document.get(CsvColumns.commission_asset.value))
+        if order_type is None or asset is None:
+            continue
+        asset_key, sum_field = asset
+
+        period = "after" if document.get(CsvColumns.commission_time.value) >= document.get("Date of trial end") \
+            else "before"
+        friend_values.setdefault(
+            f"sum_results_{period}_user_used_the_bot_for_30_days.{order_type}.{asset_key}", []
+        ).append(document.get(sum_field))
+
+    return {
+        friend_id: {path: math.fsum(path_values) for path, path_values in friend_values.items()}
+        for friend_id, friend_values in values.items()
+    }
+
+
+def parse_csv_chunk(bot_internal_id: int, chunk: bytes, since: datetime | None = None) -> tuple[list[dict], int, int]:
+    """Runs in a worker process. Returns documents parsed from the lines of the chunk, amounts of rejected rows
+    and of rows with commission time before since, that aren't returned"""
+    documents = []
+    rejected = 0
+    skipped = 0
+    for row in io.TextIOWrapper(io.BytesIO(chunk)):
+        try:
+            document = parse_csv_row(bot_internal_id, row)
+        except (ValueError, IndexError):
+            logging.debug("Rejected csv row {:}".format(row))
+            rejected += 1
+            continue
+
+        if document is None:
+            continue
+        if since is not None and document.get(CsvColumns.commission_time.value) < since:
+            skipped += 1
+            continue
+        documents.append(document)
+
+    return documents, rejected, skipped
+
+
+async def parse_csv_upload(bot_internal_id: int, file: BinaryIO, workers: int, since: datetime | None = None):
+    """Yields (documents, rejected, skipped) for every chunk of the uploaded file, in the file order.
+    Chunks are parsed on a pool of workers processes, only a couple of chunks per worker are in flight,
+    so parsed rows of the whole file are never in memory at once"""
+    loop = asyncio.get_running_loop()
+    parse_chunk = partial(parse_csv_chunk, since=since)
+    with ProcessPoolExecutor(workers) as executor:
+        in_flight = deque()
+        async for chunk in csv_chunks_from_file(file):
+            in_flight.append(loop.run_in_executor(executor, parse_chunk, bot_internal_id, chunk))
+            if len(in_flight) >= workers * 2:
+                yield await in_flight.popleft()
+
+        while in_flight:
+            yield await in_flight.popleft()
@@ -1,12 +1,19 @@
+import asyncio
 import logging
 import os
-from typing import Mapping, Any
+from collections import Counter
+from datetime import datetime
+from typing import Any, BinaryIO, Mapping
 
 from dotenv import load_dotenv
-from pymongo import MongoClient
-from pymongo.database import Database
+from motor.motor_asyncio import AsyncIOMotorClient, AsyncIOMotorDatabase
+from pymongo import ASCENDING, ReturnDocument, UpdateOne
 
-from .static.db_search_models import CommissionAsset, OrderType, CsvColumns
+from csv_common.const import CsvColumns
+from csv_common.parsing import csv_parse_workers
+
+from .csv_parsing import parse_csv_upload, row_fingerprint, sum_documents_by_friend
+from .static.const import CsvIngestSettings, IngestStates
 
 
 load_dotenv()
@@ -15,66 +22,444 @@ MONGO_URI = os.getenv("MONGODB_CONNECTION")
 if MONGO_URI is None:
     logging.critical("DB URI not found. Check .env")
 else:
-    client: MongoClient = MongoClient(MONGO_URI)
+    client: AsyncIOMotorClient = AsyncIOMotorClient(MONGO_URI)
     logging.info("Connected to the db successfully")
-    api_db: Database[Mapping[str, Any] | Any] = client["refback_api"]
+    api_db: AsyncIOMotorDatabase = client["refback_api"]
 
     csv_cache_collection = api_db["csv_cache"]
+    dataset_versions_collection = api_db["dataset_versions"]
+    csv_ingest_state_collection = api_db["csv_ingest_state"]
+    csv_summary_collection = api_db["csv_summary"]
 
 
-def read_transaction_from_cached_csv_by_bid(bid: int):
-    return csv_cache_collection.find_one({CsvColumns.friend_id_spot.value: bid})
+CSV_CACHE_INDEXES = {
+    # Calculations match on the bot and group by friend, order type and asset. Prune uses the prefix
+    "internal_id_friend_order_type_asset": [
+        ("Internal ID", ASCENDING),
+        (CsvColumns.friend_id_spot.value, ASCENDING),
+        (CsvColumns.order_type.value, ASCENDING),
+        (CsvColumns.commission_asset.value, ASCENDING),
+    ],
+    "friend_id": [
+        (CsvColumns.friend_id_spot.value, ASCENDING),
+    ],
+    # Incremental ingest reads the rows at the high-water mark and deletes the ones after it
+    "internal_id_commission_time": [
+        ("Internal ID", ASCENDING),
+        (CsvColumns.commission_time.value, ASCENDING),
+    ],
+}
 
 
-def read_all_used_buids_in_cached_csv():
-    return csv_cache_collection.distinct(CsvColumns.friend_id_spot.value)
+async def create_csv_cache_indexes():
+    """Creates indexes for the csv_cache and csv_summary queries, if they don't exist yet,
+    and checks that all csv_cache indexes are in place"""
+    for name, keys in CSV_CACHE_INDEXES.items():
+        await csv_cache_collection.create_index(keys, name=name)
 
+    await csv_summary_collection.create_index(
+        [("Internal ID", ASCENDING), (CsvColumns.friend_id_spot.value, ASCENDING)],
+        name="internal_id_friend_id",
+        unique=True
+    )
 
-def aggregate_cached_csv(
-        bot_internal_id: int,
-        order_type: str,
-        commission_asset: str,
-        less_or_more_than_30_days_from_registration: str
-):
-    if less_or_more_than_30_days_from_registration not in ["lt", "gte"]:
-        raise Exception("Input error")
-    if order_type not in [x.value for x in OrderType]:
-        raise Exception("Input error")
-    if commission_asset not in [x.value for x in CommissionAsset]:
-        raise Exception("Input error")
-
-    return csv_cache_collection.aggregate(
-        [
-            {
-                "$match": {
-                    "Internal ID": bot_internal_id,
-                    CsvColumns.order_type.value: order_type,
-                    CsvColumns.commission_asset.value: commission_asset,
-                }
-            },
-            {
-                "$match": {
-                    "$expr": {
-                        "$"+less_or_more_than_30_days_from_registration: [
-                            '$'+CsvColumns.commission_time.value, '$'+"Date of trial end"
-                        ]
-                    }
-                }
-            },
-            {
-                "$group": {
-                    "_id": "$"+CsvColumns.friend_id_spot.value,
-                    "USDT_COMMISSION_SUM": {
-                        "$sum": "$"+CsvColumns.usdt_commission_earned.value
-                    },
-                    "COIN_COMMISSION_SUM": {
-                        "$sum": "$"+CsvColumns.coin_commission_earned.value
+    existing_indexes = await csv_cache_collection.index_information()
+    missing_indexes = [name for name in CSV_CACHE_INDEXES if name not in existing_indexes]
+    if missing_indexes:
+        logging.critical("csv_cache indexes are missing: {:}".format(missing_indexes))
+    else:
+        logging.info("csv_cache indexes are in place")
+
+    return missing_indexes
+
+
+def _collect_used_indexes(plan: Mapping[str, Any] | list | Any) -> list[str]:
+    """Walks through the explain output, returns names of used indexes, or COLLSCAN for collection scans.
+    Same as _collect_used_indexes of the bot's db_indexes, keep them in sync"""
+    used_indexes = []
+
+    if type(plan) == list:
+        for node in plan:
+            used_indexes.extend(_collect_used_indexes(node))
+    elif isinstance(plan, Mapping):
+        if plan.get("stage") == "COLLSCAN":
+            used_indexes.append("COLLSCAN")
+        if plan.get("indexName") is not None:
+            used_indexes.append(plan.get("indexName"))
+        for value in plan.values():
+            used_indexes.extend(_collect_used_indexes(value))
+
+    return used_indexes
+
+
+async def read_used_indexes(bot_internal_id: int):
+    """Explains the queries that are run for the bot, returns which indexes each of them uses"""
+    calculation_plan = await api_db.command(
+        "explain",
+        {
+            "aggregate": csv_cache_collection.name,
+            "pipeline": _csv_cache_by_friend_pipeline(bot_internal_id),
+            "cursor": {}
+        },
+        verbosity="queryPlanner"
+    )
+    prune_plan = await api_db.command(
+        "explain",
+        {"delete": csv_cache_collection.name, "deletes": [{"q": {"Internal ID": bot_internal_id}, "limit": 0}]},
+        verbosity="queryPlanner"
+    )
+
+    return {
+        "calculation": sorted(set(_collect_used_indexes(calculation_plan))),
+        "prune": sorted(set(_collect_used_indexes(prune_plan))),
+    }
+
+
+async def read_transaction_from_cached_csv_by_bid(bid: int):
+    return await csv_cache_collection.find_one({CsvColumns.friend_id_spot.value: bid})
+
+
+def _csv_cache_by_friend_pipeline(bot_internal_id: int):
+    return [
+        {
+            "$match": {
+                "Internal ID": bot_internal_id,
+            }
+        },
+        {
+            "$group": {
+                "_id": {
+                    "friend_id": "$"+CsvColumns.friend_id_spot.value,
+                    "order_type": "$"+CsvColumns.order_type.value,
+                    "commission_asset": "$"+CsvColumns.commission_asset.value,
+                    "is_after_trial": {
+                        "$gte": ['$'+CsvColumns.commission_time.value, '$'+"Date of trial end"]
                     }
+                },
+                "USDT_COMMISSION_SUM": {
+                    "$sum": "$"+CsvColumns.usdt_commission_earned.value
+                },
+                "COIN_COMMISSION_SUM": {
+                    "$sum": "$"+CsvColumns.coin_commission_earned.value
                 }
-            },
-        ]
+            }
+        },
+    ]
+
+
+def aggregate_cached_csv_by_friend(bot_internal_id: int):
+    """Sums both commission columns of every row of the bot in one pass,
+    grouped by friend, order type, commission asset and whether the row is before or after the trial end"""
+    return csv_cache_collection.aggregate(_csv_cache_by_friend_pipeline(bot_internal_id))
+
+
+async def prune_cached_csv(bot_internal_id: int):
+    return await csv_cache_collection.delete_many({"Internal ID": bot_internal_id})
+
+
+async def prune_ingest_state(bot_internal_id: int):
+    """Drops the high-water mark of the bot's incremental ingest, the next upload is written from scratch"""
+    return await csv_ingest_state_collection.delete_one({"Internal ID": bot_internal_id})
+
+
+async def read_dataset_state(bot_internal_id: int) -> tuple[int, int | None, str | None]:
+    """Version of the bot's csv_cache rows, it's increased by every ingest and prune,
+    the version csv_summary was last complete for, and the IngestStates value of the upload, if there is one"""
+    dataset_version = await dataset_versions_collection.find_one({"Internal ID": bot_internal_id})
+    if dataset_version is None:
+        # Nothing was ever written, so the empty summary is complete
+        return 0, 0, None
+    return dataset_version.get("version", 0), dataset_version.get("summary_version"), dataset_version.get("ingest")
+
+
+async def set_ingest_state(bot_internal_id: int, ingest_state: str | None):
+    return await dataset_versions_collection.update_one(
+        {"Internal ID": bot_internal_id},
+        {"$set": {"ingest": ingest_state}},
+        upsert=True
+    )
+
+
+async def bump_dataset_version(bot_internal_id: int) -> int:
+    dataset_version = await dataset_versions_collection.find_one_and_update(
+        {"Internal ID": bot_internal_id},
+        {"$inc": {"version": 1}},
+        upsert=True,
+        return_document=ReturnDocument.AFTER
+    )
+    return dataset_version.get("version")
+
+
+async def invalidate_csv_summary(bot_internal_id: int):
+    """Marks csv_summary as incomplete, the raw rows are summed then"""
+    return await dataset_versions_collection.update_one(
+        {"Internal ID": bot_internal_id},
+        {"$set": {"summary_version": None}},
+        upsert=True
     )
 
 
-def prune_cached_csv(bot_internal_id: int):
-    return csv_cache_collection.delete_many({"Internal ID": bot_internal_id})
+async def set_csv_summary_version(bot_internal_id: int, summary_version: int):
+    """Marks csv_summary complete for the version, unless the rows have changed since"""
+    return await dataset_versions_collection.update_one(
+        {"Internal ID": bot_internal_id, "version": summary_version},
+        {"$set": {"summary_version": summary_version}}
+    )
+
+
+def read_csv_summary(bot_internal_id: int):
+    return csv_summary_collection.find({"Internal ID": bot_internal_id}, {"_id": 0, "Internal ID": 0})
+
+
+async def replace_csv_summary(bot_internal_id: int, sums_for_users: dict):
+    """Writes results of calculate_sum_for_users as the bot's csv_summary, one document per friend"""
+    await prune_csv_summary(bot_internal_id)
+    if sums_for_users:
+        await csv_summary_collection.insert_many(
+            [
+                {"Internal ID": bot_internal_id, CsvColumns.friend_id_spot.value: friend_id, **user_sums}
+                for friend_id, user_sums in sums_for_users.items()
+            ],
+            ordered=False
+        )
+
+
+async def prune_csv_summary(bot_internal_id: int):
+    return await csv_summary_collection.delete_many({"Internal ID": bot_internal_id})
+
+
+async def increment_csv_summary(bot_internal_id: int, sums_by_friend: dict[int, dict[str, float]]):
+    """Adds the sums to the csv_summary documents of the friends, one document per friend"""
+    if not sums_by_friend:
+        return
+
+    return await csv_summary_collection.bulk_write(
+        [
+            UpdateOne(
+                {"Internal ID": bot_internal_id, CsvColumns.friend_id_spot.value: friend_id},
+                {"$inc": sums} if sums else {"$setOnInsert": {"Internal ID": bot_internal_id}},
+                upsert=True
+            )
+            for friend_id, sums in sums_by_friend.items()
+        ],
+        ordered=False
+    )
+
+
+async def prune_dataset(bot_internal_id: int) -> int:
+    """Deletes everything that was written for the bot, returns the amount of deleted csv_cache rows"""
+    deleted_count = (await prune_cached_csv(bot_internal_id)).deleted_count
+    await prune_csv_summary(bot_internal_id)
+    await prune_ingest_state(bot_internal_id)
+    # The empty summary is complete for the empty csv_cache
+    await set_csv_summary_version(bot_internal_id, await bump_dataset_version(bot_internal_id))
+    return deleted_count
+
+
+async def read_high_water_mark(bot_internal_id: int) -> datetime | None:
+    """Latest commission time of the rows that are fully written to csv_cache"""
+    ingest_state = await csv_ingest_state_collection.find_one({"Internal ID": bot_internal_id})
+    return ingest_state.get("high_water_mark") if ingest_state is not None else None
+
+
+async def update_high_water_mark(bot_internal_id: int, high_water_mark: datetime):
+    return await csv_ingest_state_collection.update_one(
+        {"Internal ID": bot_internal_id},
+        {"$set": {"high_water_mark": high_water_mark}},
+        upsert=True
+    )
+
+
+async def read_cached_csv_fingerprints(bot_internal_id: int, commission_time: datetime) -> Counter:
+    """Fingerprints of the bot's csv_cache rows with exactly this commission time, with their counts"""
+    fingerprints = Counter()
+    async for document in csv_cache_collection.find(
+            {"Internal ID": bot_internal_id, CsvColumns.commission_time.value: commission_time}
+    ):
+        fingerprints[row_fingerprint(document)] += 1
+    return fingerprints
+
+
+async def prune_cached_csv_after(bot_internal_id: int, commission_time: datetime):
+    return await csv_cache_collection.delete_many(
+        {"Internal ID": bot_internal_id, CsvColumns.commission_time.value: {"$gt": commission_time}}
+    )
+
+
+class CsvCacheWriter:
+    """Inserts parsed csv documents in batches of batch_size.
+    In incremental mode rows before the high-water mark are skipped, rows at the mark are compared with the ones
+    already in csv_cache by fingerprints, rows after the mark are written anew"""
+
+    def __init__(self, bot_internal_id: int, batch_size: int):
+        self.bot_internal_id = bot_internal_id
+        self.batch_size = batch_size
+        self.high_water_mark: datetime | None = None
+        self.known_fingerprints = Counter()
+        self.latest_commission_time: datetime | None = None
+        self.documents_to_insert = []
+        self.inserted = 0
+        self.rejected = 0
+        self.skipped = 0
+        self.deleted = 0
+        self.dataset_version = 0
+        self.summary_is_complete = False
+
+    async def start(self):
+        self.dataset_version, summary_version, _ = await read_dataset_state(self.bot_internal_id)
+        self.summary_is_complete = summary_version == self.dataset_version
+        if self.summary_is_complete:
+            # Until the ingest finishes, the summary has only a part of the rows
+            await invalidate_csv_summary(self.bot_internal_id)
+
+    async def start_incremental(self):
+        self.high_water_mark = await read_high_water_mark(self.bot_internal_id)
+        if self.high_water_mark is None:
+            return
+
+        self.latest_commission_time = self.high_water_mark
+        # Rows after the mark may only be left by an ingest that didn't finish, the file has them all again
+        self.deleted = (await prune_cached_csv_after(self.bot_internal_id, self.high_water_mark)).deleted_count
+        if self.deleted > 0:
+            # Sums of the deleted rows may be in the summary already, the raw rows will be summed again
+            self.summary_is_complete = False
+        self.known_fingerprints = await read_cached_csv_fingerprints(self.bot_internal_id, self.high_water_mark)
+
+    async def add(self, document: dict):
+        commission_time = document.get(CsvColumns.commission_time.value)
+        if self.high_water_mark is not None:
+            if commission_time < self.high_water_mark:
+                self.skipped += 1
+                return
+            if commission_time == self.high_water_mark:
+                fingerprint = row_fingerprint(document)
+                if self.known_fingerprints[fingerprint] > 0:
+                    self.known_fingerprints[fingerprint] -= 1
+                    self.skipped += 1
+                    return
+
+        if self.latest_commission_time is None or commission_time > self.latest_commission_time:
+            self.latest_commission_time = commission_time
+
+        self.documents_to_insert.append(document)
+        if len(self.documents_to_insert) >= self.batch_size:
+            await self.flush()
+
+    async def flush(self):
+        if self.documents_to_insert:
+            self.inserted += len((await csv_cache_collection.insert_many(self.documents_to_insert)).inserted_ids)
+            if self.summary_is_complete:
+                await increment_csv_summary(self.bot_internal_id, sum_documents_by_friend(self.documents_to_insert))
+            self.documents_to_insert = []
+
+    async def finish(self):
+        await self.flush()
+
+        if self.latest_commission_time is not None:
+            await update_high_water_mark(self.bot_internal_id, self.latest_commission_time)
+        if self.inserted > 0 or self.deleted > 0:
+            # Makes the api drop calculation results it has cached for the bot
+            self.dataset_version = await bump_dataset_version(self.bot_internal_id)
+        if self.summary_is_complete:
+            await set_csv_summary_version(self.bot_internal_id, self.dataset_version)
+        await set_ingest_state(self.bot_internal_id, None)
+
+        logging.info("Inserted {:} csv rows, rejected {:}, skipped {:} already written".format(
+            self.inserted, self.rejected, self.skipped
+        ))
+        return {"inserted": self.inserted, "rejected": self.rejected, "skipped": self.skipped}
+
+
+class CsvUploadIsRunning(Exception):
+    pass
+
+
+# Bot internal id -> lock, that is held while the bot's upload is written. There is one api process,
+# so two uploads, or an upload and a prune, of the same bot never interleave
+csv_upload_locks: dict[int, asyncio.Lock] = {}
+
+
+# Bot internal id -> writer of the upload that is being written, for the progress of the upload
+csv_upload_writers: dict[int, CsvCacheWriter] = {}
+
+
+def _csv_upload_lock(bot_internal_id: int) -> asyncio.Lock:
+    return csv_upload_locks.setdefault(bot_internal_id, asyncio.Lock())
+
+
+def read_csv_upload_progress(bot_internal_id: int) -> dict | None:
+    """Amounts of rows the running upload has inserted, rejected and skipped so far, None if there is no upload"""
+    writer = csv_upload_writers.get(bot_internal_id)
+    if writer is None:
+        return None
+    return {"inserted": writer.inserted, "rejected": writer.rejected, "skipped": writer.skipped}
+
+
+async def write_csv_upload(
+        bot_internal_id: int,
+        file: BinaryIO,
+        incremental: bool = False,
+        workers: int | None = None,
+        batch_size: int = CsvIngestSettings.batch_size.value
+):
+    """Parses the uploaded .csv (or its archive) on workers processes and inserts it to csv_cache in batches,
+    so memory doesn't depend on the size of the file. Without incremental, or before the first upload,
+    everything the bot had is deleted first. With incremental, only rows that aren't in csv_cache yet
+    are inserted, the file must include everything up to the previous upload.
+    Raises CsvUploadIsRunning if the bot's previous upload isn't written yet.
+    If the upload breaks off, the dataset is marked failed and isn't calculated until the next one succeeds.
+    Returns amounts of inserted, rejected and skipped rows"""
+    lock = _csv_upload_lock(bot_internal_id)
+    if lock.locked():
+        raise CsvUploadIsRunning("Previous csv upload of the bot is still being written")
+
+    async with lock:
+        # Calculations don't read or rebuild the summary until finish, they would race with the $inc of flush
+        await set_ingest_state(bot_internal_id, IngestStates.running.value)
+        try:
+            return await _write_csv_upload(bot_internal_id, file, incremental, workers, batch_size)
+        except BaseException:
+            await set_ingest_state(bot_internal_id, IngestStates.failed.value)
+            raise
+        finally:
+            csv_upload_writers.pop(bot_internal_id, None)
+
+
+async def _write_csv_upload(bot_internal_id: int, file: BinaryIO, incremental: bool, workers: int | None,
+                            batch_size: int):
+    if workers is None:
+        workers = csv_parse_workers()
+
+    if not incremental or await read_high_water_mark(bot_internal_id) is None:
+        incremental = False
+        await prune_dataset(bot_internal_id)
+
+    writer = CsvCacheWriter(bot_internal_id, batch_size)
+    csv_upload_writers[bot_internal_id] = writer
+    await writer.start()
+    if incremental:
+        await writer.start_incremental()
+
+    # Rows before the mark are dropped right in the workers, so they aren't even sent to this process
+    async for documents, rejected, skipped in parse_csv_upload(bot_internal_id, file, workers, writer.high_water_mark):
+        writer.rejected += rejected
+        writer.skipped += skipped
+        for document in documents:
+            await writer.add(document)
+
+    result = await writer.finish()
+    result["incremental"] = incremental
+    return result
+
+
+async def prune_csv_upload(bot_internal_id: int) -> int:
+    """prune_dataset, that waits for nothing: raises CsvUploadIsRunning if the bot's upload is being written.
+    The empty dataset is a good one, so a failed upload doesn't block calculations after it"""
+    lock = _csv_upload_lock(bot_internal_id)
+    if lock.locked():
+        raise CsvUploadIsRunning("Csv upload of the bot is being written")
+
+    async with lock:
+        deleted_count = await prune_dataset(bot_internal_id)
+        await set_ingest_state(bot_internal_id, None)
+        return deleted_count
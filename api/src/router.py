@@ -1,18 +1,55 @@
-from fastapi import APIRouter
-from .calculations import calculate_sum_for_users
-from .db import prune_cached_csv
+from fastapi import APIRouter, HTTPException, Response, UploadFile
+from .calculations import DatasetIsNotReady, read_calculation_results
+from .db import CsvUploadIsRunning, prune_csv_upload, read_csv_upload_progress, read_used_indexes, write_csv_upload
 
 router = APIRouter(prefix="/calculations", tags=["Image"])
 
 
 @router.get("/get_calculation_results_for_all_users/{}")
 async def get_calculation_results_for_all_users(bot_internal_id: int):
-    return calculate_sum_for_users(bot_internal_id)
+    try:
+        results, is_cache_hit = await read_calculation_results(bot_internal_id)
+    except DatasetIsNotReady as e:
+        raise HTTPException(status_code=409, detail=str(e))
+    return Response(
+        content=results,
+        media_type="application/json",
+        headers={"X-Cache": "HIT" if is_cache_hit else "MISS"}
+    )
 
 
 @router.post("/prune_db_documents_with_internal_id/{}")
 async def prune_db_documents_with_internal_id(bot_internal_id: int):
-    if prune_cached_csv(bot_internal_id).deleted_count > 0:
+    try:
+        deleted_count = await prune_csv_upload(bot_internal_id)
+    except CsvUploadIsRunning as e:
+        raise HTTPException(status_code=409, detail=str(e))
+
+    if deleted_count > 0:
         return "Success"
     else:
         return "Nothing was deleted, perhaps there is nothing to prune"
+
+
+@router.post("/upload/{}")
+async def upload(bot_internal_id: int, file: UploadFile, incremental: bool = False):
+    # UploadFile keeps only the first megabyte in memory, the rest of the upload is spooled to the disk
+    try:
+        return await write_csv_upload(bot_internal_id, file.file, incremental)
+    except CsvUploadIsRunning as e:
+        raise HTTPException(status_code=409, detail=str(e))
+    finally:
+        await file.close()
+
+
+@router.get("/upload_progress/{}")
+async def upload_progress(bot_internal_id: int):
+    progress = read_csv_upload_progress(bot_internal_id)
+    if progress is None:
+        raise HTTPException(status_code=404, detail="No csv upload of the bot is being written")
+    return progress
+
+
+@router.get("/used_indexes/{}")
+async def used_indexes(bot_internal_id: int):
+    return await read_used_indexes(bot_internal_id)
@@ -0,0 +1,17 @@
+from enum import Enum
+
+
+class CsvIngestSettings(Enum):
+    # Rows inserted to csv_cache at once
+    batch_size = 5000
+    # Bytes of the file one worker process parses at once
+    chunk_size = 4 * 1024 * 1024
+    # Bytes read from the uploaded file at once
+    read_size = 256 * 1024
+
+
+class IngestStates(Enum):
+    # An upload is being written, csv_cache and csv_summary have only a part of it
+    running = "running"
+    # The upload broke off, csv_cache may have been pruned or be partial, until the next upload succeeds
+    failed = "failed"
@@ -6,16 +6,21 @@ from telegram.ext import (
     MessageHandler,
     CallbackQueryHandler,
     ContextTypes,
+    TypeHandler,
     filters, ConversationHandler, CallbackContext,
 )
 from telegram import Update
 from telegram.warnings import PTBUserWarning
 
 from src.db import read_selected_ticket
-from src.middleware import main_handler, is_admin, generate_command_list
+from src.db_indexes import ensure_indexes
+from src.outbox import recover_outbox, send_outbox
+from src.middleware import main_handler, is_admin, generate_command_list, load_update_context, \
+    flush_update_context, flush_nicknames, flush_nicknames_on_shutdown, admin_roster
 from src import admin, support
 from src import commands
-from src.static.const import CommandsWithDescriptions, QueryCategories, CommandsRelated, AdminLevels, QueryCommands
+from src.static.const import CommandsWithDescriptions, QueryCategories, CommandsRelated, AdminLevels, QueryCommands, \
+    FlushIntervals, OutboxSettings
 
 from dotenv import load_dotenv
 from sys import stderr
@@ -87,12 +92,12 @@ async def callback_query_distributor(update: Update, context: ContextTypes.DEFAU
 
 async def all_text_handler(update: Update, context: CallbackContext):
     """This function handles all non-conversationHandler related text inputs"""
-    main_handler(update.effective_chat.id, update.effective_user.first_name, update.effective_user.username)
+    await main_handler(update.effective_chat.id, update.effective_user.first_name, update.effective_user.username)
 
     user_type = (
-        "support_agent" if is_admin(update, AdminLevels.support_level.value) else "user"
+        "support_agent" if await is_admin(update, AdminLevels.support_level.value) else "user"
     )
-    ticket = read_selected_ticket(update.effective_chat.id, user_type)
+    ticket = await read_selected_ticket(update.effective_chat.id, user_type)
 
     if update.message is None:
         return
@@ -112,13 +117,20 @@ async def all_text_handler(update: Update, context: CallbackContext):
 
 
 async def unknown_text(update: Update, context: CallbackContext):
-    main_handler(update.effective_chat.id, update.effective_user.first_name, update.effective_user.username)
+    await main_handler(update.effective_chat.id, update.effective_user.first_name, update.effective_user.username)
 
     await context.bot.send_message(
         chat_id=update.message.chat_id, text=i18n.t("translation.unknown_text")
     )
 
 
+async def post_init(application: Application):
+    await ensure_indexes()
+    await recover_outbox()
+    await admin_roster.load()
+    await generate_command_list(application)
+
+
 def main() -> None:
     # Get bot token from .env file
     load_dotenv()
@@ -129,7 +141,28 @@ def main() -> None:
         logging.critical("TG_BOT token not found. Check .env")
         return
 
-    application = Application.builder().token(bot_token).post_init(generate_command_list).build()
+    application = Application.builder()\
+        .token(bot_token)\
+        .post_init(post_init)\
+        .post_shutdown(flush_nicknames_on_shutdown)\
+        .build()
+
+    application.job_queue.run_repeating(
+        flush_nicknames,
+        interval=FlushIntervals.nicknames.value,
+        name="flush_nicknames"
+    )
+    # The second instance returns at once if the previous run is still sending
+    application.job_queue.run_repeating(
+        send_outbox,
+        interval=OutboxSettings.interval.value,
+        name="send_outbox",
+        job_kwargs={"max_instances": 2}
+    )
+
+    # Chat and restrictions are read once before all handlers, and written back once after them
+    application.add_handler(TypeHandler(Update, load_update_context), -1)
+    application.add_handler(TypeHandler(Update, flush_update_context), 1)
 
     """Place for ConversationHandlers. Should be registered in the top, 
         because can be called with callback that should be handled with their own handlers"""
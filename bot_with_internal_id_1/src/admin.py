@@ -1,17 +1,13 @@
-import json
-import os
 import re
 
 import i18n
-import requests
 from telegram import InlineKeyboardButton, InlineKeyboardMarkup, Update
 from telegram.constants import ParseMode
 from telegram.ext import CallbackContext, ConversationHandler
 
-from .bot_notifications import notify_about_new_payoff, notify_about_decreased_level, notify_about_increased_level
-from .static.const import AdminLevels, QueryCommands, QueryCategories, Other
-from .middleware import is_admin, is_chat_private, main_handler, calculate_cashback_for_user_with_id, \
-    generate_list_of_current_withdraws
+from .bot_notifications import broadcast_new_payoffs, notify_about_decreased_level, notify_about_increased_level
+from .static.const import AdminLevels, QueryCommands, QueryCategories
+from .middleware import is_admin, is_chat_private, main_handler
 from .db import (
     assign_ticket_to_support_agent,
     close_support_ticket,
@@ -20,15 +16,17 @@ from .db import (
     read_chat,
     read_ticket,
     select_support_ticket,
-    write_lines_from_csv, read_all_users_with_not_null_withdraw_amounts, increase_level, decrease_level, read_bid,
-    prune_withdraw_records
+    increase_level, decrease_level, read_bid
 )
+from .calculation_job import cancel_calculation, is_calculation_running, start_calculation
+from .compression import CSV_FILE_SUFFIXES
+from .downloads import StreamingDownload
 from .support import send_all_messages_from_saved
 
 
-def constant_checks(update: Update, context: CallbackContext):
-    main_handler(update.effective_chat.id, update.effective_user.first_name, update.effective_user.username)
-    if not is_admin(update, AdminLevels.support_level.value):
+async def constant_checks(update: Update, context: CallbackContext):
+    await main_handler(update.effective_chat.id, update.effective_user.first_name, update.effective_user.username)
+    if not await is_admin(update, AdminLevels.support_level.value):
         return
     if not is_chat_private(update, context):
         return
@@ -37,7 +35,7 @@ def constant_checks(update: Update, context: CallbackContext):
 
 
 async def admin_menu(update: Update, context: CallbackContext):
-    if not constant_checks(update, context):
+    if not await constant_checks(update, context):
         return
 
     await update.message.reply_text(
@@ -91,12 +89,12 @@ async def admin_menu(update: Update, context: CallbackContext):
 async def list_new_tickets(update: Update, context: CallbackContext) -> None:
     """Searches for tickets that are subscribed to tg_user_id of the admin,
     sends them all in separate messages with the inline button to enter"""
-    if not constant_checks(update, context):
+    if not await constant_checks(update, context):
         return
 
     is_there_tickets = False
 
-    for ticket in read_all_new_tickets():
+    async for ticket in await read_all_new_tickets():
         await update.effective_chat.send_message(
             text=ticket.get("heading", "None"),
             reply_markup=InlineKeyboardMarkup(
@@ -123,12 +121,12 @@ async def list_new_tickets(update: Update, context: CallbackContext) -> None:
 
 
 async def list_admins_tickets(update: Update, context: CallbackContext) -> None:
-    if not constant_checks(update, context):
+    if not await constant_checks(update, context):
         return
 
     is_there_tickets = False
 
-    for ticket in read_agent_tickets(update.effective_chat.id, False, heading=1, _id=1):
+    async for ticket in await read_agent_tickets(update.effective_chat.id, False, heading=1, _id=1):
         await update.effective_chat.send_message(
             text=ticket.get("heading", "None"),
             reply_markup=InlineKeyboardMarkup(
@@ -162,38 +160,30 @@ async def list_admins_tickets(update: Update, context: CallbackContext) -> None:
         await update.effective_chat.send_message(i18n.t("translation.nothing_found"))
 
 
-def close_ticket(update: Update, context: CallbackContext, ticket_id: str):
-    if not constant_checks(update, context):
+async def close_ticket(update: Update, context: CallbackContext, ticket_id: str):
+    if not await constant_checks(update, context):
         return
 
-    amount_of_changed = close_support_ticket(ticket_id).modified_count
+    amount_of_changed = (await close_support_ticket(ticket_id)).modified_count
 
     return True if amount_of_changed >= 1 else False
 
 
 async def notify_about_new_payoff_button(update: Update, context: CallbackContext):
-    if not constant_checks(update, context):
+    if not await constant_checks(update, context):
         return
 
-    for user in read_all_users_with_not_null_withdraw_amounts():
-        chat_id = user.get("chat_id")
-
-        try:
-            await notify_about_new_payoff(chat_id, context)
-        except Exception:
-            await context.bot.send_message(
-                update.effective_chat.id,
-                i18n.t("translation.admin.failed_to_notify_user").format(
-                    user.get("real_name"), user.get("tg_name", " ")
-                )
-            )
+    # Thousands of messages take minutes even at the full rate, the bot keeps answering meanwhile
+    context.job_queue.run_once(
+        broadcast_new_payoffs, 0, name="new_payoff_broadcast", chat_id=update.effective_chat.id
+    )
 
 
 class NewCalculation:
     link = range(1)
 
     async def get_link_to_filechanger_or_document(self, update: Update, context: CallbackContext):
-        if not constant_checks(update, context):
+        if not await constant_checks(update, context):
             return
 
         await update.callback_query.answer()
@@ -206,7 +196,7 @@ class NewCalculation:
 
     @staticmethod
     async def cancel(update: Update, context: CallbackContext):
-        if not constant_checks(update, context):
+        if not await constant_checks(update, context):
             return
 
         await context.bot.send_message(update.effective_chat.id, i18n.t("translation.cancelled"))
@@ -214,106 +204,56 @@ class NewCalculation:
 
     @staticmethod
     async def finish(update: Update, context: CallbackContext):
-        async def _exception():
-            await context.bot.send_message(
-                update.effective_chat.id,
-                i18n.t("translation.error")
-            )
-
         if update.message.document is not None or update.message.text is not None:
+            # The running calculation may still be reading newest.csv, it mustn't be overwritten
+            if is_calculation_running():
+                await context.bot.send_message(
+                    update.effective_chat.id,
+                    i18n.t("translation.admin.calculation_is_already_running")
+                )
+                return ConversationHandler.END
+
+            download = None
             if update.message.text is not None:
-                if re.fullmatch(r"https://pixeldrain.com/u/[a-zA-Z0-9]{3,12}", update.message.text) is not None:
-                    code = str(update.message.text).lstrip("https://pixeldrain.com/u/").split("?")[0]
-                    link = "https://pixeldrain.com/api/file/" + str(code) + "?download"
-                    get = requests.get(
-                        link,
-                        headers={
-                            "User-Agent": "Mozilla/5.0 (Windows NT 10.0; Win64; x64) "
-                                          "AppleWebKit/537.36 (KHTML, like Gecko) Chrome/116.0.0.0 Safari/537.36"
-                        }
-                    )
+                pixeldrain_link = re.fullmatch(r"https://pixeldrain.com/u/([a-zA-Z0-9]{3,12})", update.message.text)
+                if pixeldrain_link is not None:
+                    link = "https://pixeldrain.com/api/file/" + pixeldrain_link.group(1) + "?download"
                 elif re.fullmatch(
                         r"https://filetransfer.io/data-package/[a-zA-Z0-9]{3,12}/download",
                         update.message.text
                 ) is not None:
-                    get = requests.get(
-                        update.message.text,
-                        headers={
-                            "User-Agent": "Mozilla/5.0 (Windows NT 10.0; Win64; x64) "
-                                          "AppleWebKit/537.36 (KHTML, like Gecko) Chrome/116.0.0.0 Safari/537.36"
-                        }
-                    )
+                    link = update.message.text
                 else:
                     await context.bot.send_message(update.effective_chat.id, i18n.t("translation.admin.wrong_link"))
                     return ConversationHandler.END
 
-                with open("newest.csv", "wb") as f:
-                    if get.status_code == 200:
-                        f.write(get.content)
-                    else:
-                        await _exception()
+                download = StreamingDownload(
+                    link,
+                    "newest.csv",
+                    headers={
+                        "User-Agent": "Mozilla/5.0 (Windows NT 10.0; Win64; x64) "
+                                      "AppleWebKit/537.36 (KHTML, like Gecko) Chrome/116.0.0.0 Safari/537.36"
+                    }
+                )
 
             if update.message.document is not None:
-                if update.message.document.file_name[-4:] == ".csv":
+                if update.message.document.file_name.endswith(CSV_FILE_SUFFIXES):
                     file = await context.bot.get_file(update.message.document.file_id)
-                    await file.download_to_drive("newest.csv")
-
-            await context.bot.send_message(update.message.from_user.id, i18n.t("translation.admin.started_calculation"))
-
-            with open("newest.csv", "r") as f:
-                file = f.read()
-
-            api_location = os.getenv("API_LOCATION")
-            if api_location is None:
-                await context.bot.send_message(update.effective_chat.id, i18n.t("translation.wrong_env_config"))
-
-            # Prune api db
-            prune_result = requests.post(
-                api_location +
-                "calculations/prune_db_documents_with_internal_id/{}?bot_internal_id=" +
-                str(Other.bot_id.value)
-            )
-            if prune_result.status_code != 200:
-                await context.bot.send_message(
-                    update.effective_chat.id,
-                    i18n.t("translation.admin.error_during_db_prune")
-                )
-                return ConversationHandler.END
-
-            # Prune users withdraw values
-            prune_withdraw_records()
-
-            # Write data to the db
-            write_lines_from_csv(Other.bot_id.value, file)
+                    if file.file_path.startswith("http"):
+                        download = StreamingDownload(file.file_path, "newest.csv")
+                    else:
+                        # Local bot api server gives a path on its disk instead of a link
+                        await file.download_to_drive("newest.csv")
 
-            # Get calculations from the api
-            cashback_results = requests.get(
-                api_location +
-                "calculations/get_calculation_results_for_all_users/{}?bot_internal_id=" +
-                str(Other.bot_id.value)
-            )
-            if cashback_results.status_code != 200:
+            # The calculation takes minutes, the bot keeps answering others while it runs on the job queue
+            if not start_calculation(context, update.effective_chat.id, download):
                 await context.bot.send_message(
                     update.effective_chat.id,
-                    i18n.t("translation.admin.error_during_api_calculations")
+                    i18n.t("translation.admin.calculation_is_already_running")
                 )
                 return ConversationHandler.END
 
-            # Calculate with ratios for this user, save to the db
-            calculation_results: dict = json.loads(cashback_results.text)
-            for bid in calculation_results:
-                calculate_cashback_for_user_with_id(
-                    calculation_results.get(bid),
-                    int(bid)
-                )
-
-            await context.bot.send_message(update.effective_chat.id, i18n.t("translation.admin.calculation_successful"))
-
-            await context.bot.send_message(
-                update.effective_chat.id,
-                await generate_list_of_current_withdraws(update, context),
-                ParseMode.HTML
-            )
+            await context.bot.send_message(update.message.from_user.id, i18n.t("translation.admin.started_calculation"))
 
             return ConversationHandler.END
         else:
@@ -330,14 +270,16 @@ class IncreaseLevel:
 
     @staticmethod
     async def finish(update: Update, context: CallbackContext):
-        if not constant_checks(update, context):
+        if not await constant_checks(update, context):
             return
 
         if re.fullmatch(r"[0-9]+", update.message.text) is not None:
-            result = increase_level(int(update.message.text))
+            result = await increase_level(int(update.message.text))
             if result is not None and result.modified_count >= 1:
                 await context.bot.send_message(update.effective_chat.id, i18n.t("translation.success"))
-                await notify_about_increased_level(read_bid(int(update.message.text)).get("chat_id"), context)
+                await notify_about_increased_level(
+                    (await read_bid(int(update.message.text))).get("chat_id"), update.update_id
+                )
             else:
                 await context.bot.send_message(
                     update.effective_chat.id,
@@ -348,7 +290,7 @@ class IncreaseLevel:
 
     @staticmethod
     async def cancel(update: Update, context: CallbackContext):
-        if not constant_checks(update, context):
+        if not await constant_checks(update, context):
             return
 
         await context.bot.send_message(update.effective_chat.id, i18n.t("translation.cancelled"))
@@ -366,14 +308,16 @@ class DecreaseLevel:
 
     @staticmethod
     async def finish(update: Update, context: CallbackContext):
-        if not constant_checks(update, context):
+        if not await constant_checks(update, context):
             return
 
         if re.fullmatch(r"[0-9]+", update.message.text) is not None:
-            result = decrease_level(int(update.message.text))
+            result = await decrease_level(int(update.message.text))
             if result is not None and result.modified_count >= 1:
                 await context.bot.send_message(update.effective_chat.id, i18n.t("translation.success"))
-                await notify_about_decreased_level(read_bid(int(update.message.text)).get("chat_id"), context)
+                await notify_about_decreased_level(
+                    (await read_bid(int(update.message.text))).get("chat_id"), update.update_id
+                )
             else:
                 await context.bot.send_message(
                     update.effective_chat.id,
@@ -384,7 +328,7 @@ class DecreaseLevel:
 
     @staticmethod
     async def cancel(update: Update, context: CallbackContext):
-        if not constant_checks(update, context):
+        if not await constant_checks(update, context):
             return
 
         await context.bot.send_message(update.effective_chat.id, i18n.t("translation.cancelled"))
@@ -393,7 +337,7 @@ class DecreaseLevel:
 
 
 async def query_handler_admin(update: Update, context: CallbackContext):
-    main_handler(update.effective_chat.id, update.effective_user.first_name, update.effective_user.username)
+    await main_handler(update.effective_chat.id, update.effective_user.first_name, update.effective_user.username)
     query_with_id = update.callback_query.data.split("*")[1:]
     query = query_with_id[0]
 
@@ -434,6 +378,15 @@ async def query_handler_admin(update: Update, context: CallbackContext):
 
         await update.callback_query.answer()
 
+    elif query == QueryCommands.cancel_calculation.value:
+        if not await constant_checks(update, context):
+            return
+
+        if cancel_calculation(update.effective_chat.id):
+            await update.callback_query.answer(i18n.t("translation.admin.cancelling_calculation"))
+        else:
+            await update.callback_query.answer(i18n.t("translation.admin.no_calculation_to_cancel"))
+
     elif query == QueryCommands.delete.value:
         await update.callback_query.answer()
         await context.bot.delete_message(
@@ -448,21 +401,21 @@ async def query_handler_admin(update: Update, context: CallbackContext):
     elif query == QueryCommands.notify_new_payoff.value:
         await notify_about_new_payoff_button(update, context)
         await update.callback_query.answer()
-        await context.bot.send_message(update.effective_chat.id, i18n.t("translation.success"))
+        await context.bot.send_message(update.effective_chat.id, i18n.t("translation.admin.started_broadcast"))
 
     elif query == QueryCommands.my_open_tickets.value:
         await list_admins_tickets(update, context)
         await update.callback_query.answer()
 
     elif len(query_with_id) == 2 and query_with_id[0] == QueryCommands.ticket.value:
-        if not constant_checks(update, context):
+        if not await constant_checks(update, context):
             return
-        response = assign_ticket_to_support_agent(
+        response = await assign_ticket_to_support_agent(
             update.effective_chat.id, query_with_id[1]
         )
-        ticket = read_ticket(query_with_id[1])
+        ticket = await read_ticket(query_with_id[1])
 
-        select_support_ticket(query_with_id[1], update.effective_chat.id, "support")
+        await select_support_ticket(query_with_id[1], update.effective_chat.id, "support")
         await update.callback_query.answer(
             i18n.t("translation.success")
             if response.modified_count >= 1
@@ -475,25 +428,25 @@ async def query_handler_admin(update: Update, context: CallbackContext):
                 ),
                 parse_mode=ParseMode.MARKDOWN,
             )
-            ticket = read_ticket(query_with_id[1])
+            ticket = await read_ticket(query_with_id[1])
             await context.bot.send_message(
                 ticket.get("chat_id"),
                 i18n.t(
                     "translation.your_ticket_was_opened",
-                    locale=read_chat(ticket.get("chat_id")).get("language"),
+                    locale=(await read_chat(ticket.get("chat_id"))).get("language"),
                 ).format(ticket.get("heading")),
                 parse_mode=ParseMode.MARKDOWN,
             )
 
     # If ticket select button is pressed
     elif len(query_with_id) == 2 and query_with_id[0] == QueryCommands.ticket_select.value:
-        ticket = read_ticket(query_with_id[1])
+        ticket = await read_ticket(query_with_id[1])
 
         if (
             ticket.get("selected_by_support") is None
             and ticket.get("state") != "closed"
         ):
-            select_support_ticket(query_with_id[1], update.effective_chat.id, "support")
+            await select_support_ticket(query_with_id[1], update.effective_chat.id, "support")
             await update.callback_query.message.reply_text(
                 i18n.t("translation.formatted.you_have_selected_ticket_no").format(
                     query_with_id[1], ticket.get("heading"), ticket.get("uid")
@@ -542,16 +495,16 @@ async def query_handler_admin(update: Update, context: CallbackContext):
     # If the button pressed in the confirmation menu
     elif len(query_with_id) == 3 and query_with_id[0] == QueryCommands.ticket_close.value:
         if query_with_id[2] == "True":
-            if close_ticket(update, context, query_with_id[1]):
+            if await close_ticket(update, context, query_with_id[1]):
                 await update.callback_query.answer(i18n.t("translation.success"))
 
-                ticket = read_ticket(query_with_id[1])
+                ticket = await read_ticket(query_with_id[1])
                 try:
                     await context.bot.send_message(
                         ticket.get("chat_id"),
                         i18n.t(
                             "translation.formatted.the_ticket_was_closed",
-                            locale=read_chat(ticket.get("chat_id")).get("language"),
+                            locale=(await read_chat(ticket.get("chat_id"))).get("language"),
                         ).format(ticket.get("heading")),
                         parse_mode=ParseMode.MARKDOWN,
                     )
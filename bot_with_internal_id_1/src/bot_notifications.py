@@ -1,28 +1,32 @@
 import i18n
 from telegram.constants import ParseMode
 from telegram.ext import CallbackContext
-from .db import read_chat, read_all_admins
-from .static.const import MinimumWithdrawValues
+from .db import read_chat, read_all_users_with_not_null_withdraw_amounts, write_outbox_messages
+from .middleware import admin_roster
+from .outbox import outbox_message, wait_for_outbox_messages
+from .static.const import AdminLevels, MinimumWithdrawValues, OutboxSettings, OutboxStates
 
 
-async def notify_about_increased_level(user_tg_id, context: CallbackContext):
-    user = read_chat(user_tg_id)
-    await context.bot.send_message(
+async def notify_about_increased_level(user_tg_id, update_id: int):
+    user = await read_chat(user_tg_id)
+    await write_outbox_messages([outbox_message(
+        "level_increased:{:}".format(update_id),
         user_tg_id,
         i18n.t("translation.level_increased", locale=user.get("language", "ru"))
-    )
+    )])
 
 
-async def notify_about_decreased_level(user_tg_id, context: CallbackContext):
-    user = read_chat(user_tg_id)
-    await context.bot.send_message(
+async def notify_about_decreased_level(user_tg_id, update_id: int):
+    user = await read_chat(user_tg_id)
+    await write_outbox_messages([outbox_message(
+        "level_decreased:{:}".format(update_id),
         user_tg_id,
         i18n.t("translation.level_decreased", locale=user.get("language", "ru"))
-    )
+    )])
 
 
-async def notify_about_new_payoff(user_tg_id, context: CallbackContext):
-    user = read_chat(user_tg_id)
+def new_payoff_text(user: dict):
+    """Text of the payoff notification for the chat document, None if there is nothing to withdraw"""
     available_to_withdraw_usdt = user.get("available_to_withdraw_usdt")
     available_to_withdraw_bnb = user.get("available_to_withdraw_bnb")
 
@@ -31,33 +35,74 @@ async def notify_about_new_payoff(user_tg_id, context: CallbackContext):
 
     if available_to_withdraw_usdt > usdt_min or available_to_withdraw_bnb > bnb_min:
         if available_to_withdraw_usdt > usdt_min and available_to_withdraw_bnb > bnb_min:
-            text = i18n.t("translation.formatted.you_got_new_payoff")\
+            return i18n.t("translation.formatted.you_got_new_payoff")\
                 .format(f"{available_to_withdraw_usdt}USDT {available_to_withdraw_bnb}BNB")
         elif available_to_withdraw_usdt > usdt_min:
-            text = i18n.t("translation.formatted.you_got_new_payoff")\
+            return i18n.t("translation.formatted.you_got_new_payoff")\
                 .format(f"{available_to_withdraw_usdt}USDT")
         elif available_to_withdraw_bnb > bnb_min:
-            text = i18n.t("translation.formatted.you_got_new_payoff")\
+            return i18n.t("translation.formatted.you_got_new_payoff")\
                 .format(f"{available_to_withdraw_bnb}BNB")
         else:
-            text = i18n.t("translation.error")
-        await context.bot.send_message(
-            user_tg_id,
-            text
+            return i18n.t("translation.error")
+
+
+def new_payoff_message(user: dict):
+    """The payoff of one calculation is announced once, pressing the button again only sends what wasn't sent yet"""
+    text = new_payoff_text(user)
+    if text is None:
+        return
+    return outbox_message(
+        "new_payoff:{:}:{:}:{:}:{:}".format(
+            user.get("chat_id"),
+            user.get("payoff_calculation_id"),
+            user.get("available_to_withdraw_usdt"),
+            user.get("available_to_withdraw_bnb")
+        ),
+        user.get("chat_id"),
+        text
+    )
+
+
+async def broadcast_new_payoffs(context: CallbackContext):
+    """Job queue callback, context.job.chat_id is the admin, that gets the summary"""
+    dedupe_keys = []
+    messages = []
+    # The cursor already has the whole chat documents, they aren't read again one by one
+    async for user in await read_all_users_with_not_null_withdraw_amounts():
+        message = new_payoff_message(user)
+        if message is None:
+            continue
+        messages.append(message)
+        if len(messages) >= OutboxSettings.write_batch_size.value:
+            await write_outbox_messages(messages)
+            dedupe_keys.extend(message.get("dedupe_key") for message in messages)
+            messages = []
+    await write_outbox_messages(messages)
+    dedupe_keys.extend(message.get("dedupe_key") for message in messages)
+
+    states = await wait_for_outbox_messages(dedupe_keys)
+    await context.bot.send_message(
+        context.job.chat_id,
+        i18n.t("translation.admin.formatted.broadcast_result").format(
+            states.get(OutboxStates.sent.value, 0),
+            states.get(OutboxStates.failed.value, 0) + states.get(OutboxStates.interrupted.value, 0),
+            states.get(OutboxStates.blocked.value, 0)
         )
+    )
 
 
-async def notify_about_new_user(name, b_id, context: CallbackContext, username=""):
+async def notify_about_new_user(name, b_id, username=""):
     if username is None:
         username = ""
 
-    for admin in read_all_admins(1):
-        try:
-            await context.bot.send_message(
-                admin.get("chat_id"),
-                "<b>Новый пользователь!</b>\n{:s}\n@{:s}\n{:}".format(name, username, b_id) if username != ""
-                else "<b>New user!</b>\n{:s}\n{:}".format(name, b_id),
-                parse_mode=ParseMode.HTML
-            )
-        except Exception as e:
-            print(e)
+    await write_outbox_messages([
+        outbox_message(
+            "new_user:{:}:{:}".format(admin.get("chat_id"), b_id),
+            admin.get("chat_id"),
+            "<b>Новый пользователь!</b>\n{:s}\n@{:s}\n{:}".format(name, username, b_id) if username != ""
+            else "<b>New user!</b>\n{:s}\n{:}".format(name, b_id),
+            parse_mode=ParseMode.HTML
+        )
+        for admin in await admin_roster.read(AdminLevels.any_admin.value)
+    ])
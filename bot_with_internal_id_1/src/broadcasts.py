@@ -0,0 +1,83 @@
+import asyncio
+import logging
+import time
+
+from telegram import Bot
+from telegram.error import BadRequest, Forbidden, NetworkError, RetryAfter
+
+from .static.const import BroadcastSettings, OutboxStates
+
+
+class TokenBucket:
+    """Lets through rate acquires a second on average, capacity of them at once after a pause"""
+
+    def __init__(self, rate: float, capacity: float):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = time.monotonic()
+        self.paused_until = 0.0
+        self._lock = asyncio.Lock()
+
+    async def acquire(self):
+        # Waiters take the lock in turn, so they get tokens in the order they came
+        async with self._lock:
+            while True:
+                now = time.monotonic()
+                if now < self.paused_until:
+                    await asyncio.sleep(self.paused_until - now)
+                    continue
+
+                self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+                self.updated = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                await asyncio.sleep((1 - self.tokens) / self.rate)
+
+    def pause(self, seconds: float):
+        """Telegram asked to wait, nobody gets a token until then"""
+        self.paused_until = max(self.paused_until, time.monotonic() + seconds)
+        self.tokens = 0
+        self.updated = self.paused_until
+
+
+class Broadcast:
+    """Sends messages to many chats at once, as fast as the limits of Telegram allow"""
+
+    def __init__(self, bot: Bot):
+        self.bot = bot
+        self.global_bucket = TokenBucket(BroadcastSettings.global_rate.value, BroadcastSettings.global_rate.value)
+        self.chat_buckets: dict[int, TokenBucket] = {}
+
+    def _chat_bucket(self, chat_id: int) -> TokenBucket:
+        if chat_id not in self.chat_buckets:
+            self.chat_buckets[chat_id] = TokenBucket(BroadcastSettings.per_chat_rate.value, 1)
+        return self.chat_buckets[chat_id]
+
+    async def send(self, chat_id: int, text: str, **kwargs) -> OutboxStates:
+        """Returns sent, blocked, failed if sending again won't help, or pending if it may help later"""
+        for attempt in range(BroadcastSettings.max_attempts.value):
+            await self.global_bucket.acquire()
+            await self._chat_bucket(chat_id).acquire()
+            try:
+                await self.bot.send_message(chat_id, text, **kwargs)
+                return OutboxStates.sent
+            except RetryAfter as e:
+                # Flood wait is for the whole bot, not only for this chat
+                logging.warning("Flood wait for {:} seconds during the broadcast".format(e.retry_after))
+                self.global_bucket.pause(e.retry_after)
+            except Forbidden as e:
+                logging.info("Chat {:} has blocked the bot: {:}".format(chat_id, e))
+                return OutboxStates.blocked
+            except BadRequest as e:
+                # Chat not found and the like
+                logging.error("Failed to send a broadcast message to {:}: {:}".format(chat_id, e))
+                return OutboxStates.failed
+            except NetworkError as e:
+                logging.warning("Network error while sending to {:}: {:}".format(chat_id, e))
+                if attempt < BroadcastSettings.max_attempts.value - 1:
+                    await asyncio.sleep(BroadcastSettings.backoff.value * 2 ** attempt)
+
+        logging.warning("Postponed a broadcast message to {:}".format(chat_id))
+        return OutboxStates.pending
@@ -0,0 +1,273 @@
+import asyncio
+import logging
+import os
+import uuid
+
+import httpx
+import i18n
+from telegram import InlineKeyboardButton, InlineKeyboardMarkup, Message
+from telegram.constants import ParseMode
+from telegram.error import BadRequest
+from telegram.ext import CallbackContext
+
+from .csv_parsing import CsvAggregator, aggregate_csv_file
+from .downloads import StreamingDownload, download_progress_text
+from .middleware import calculate_cashback_for_all_users, generate_list_of_current_withdraws
+from .static.const import CalculationStages, DownloadSettings, Other, QueryCategories, QueryCommands
+from .uploads import upload_csv_file
+
+
+class CalculationJob:
+    """Calculation, that runs on the job queue, so the bot keeps answering while it goes.
+    The admin sees its stage and counters in one message, that is edited while the job runs"""
+
+    def __init__(self, chat_id: int, download: StreamingDownload | None = None):
+        self.chat_id = chat_id
+        self.id = uuid.uuid4().hex
+        self.download = download
+        self.download_task: asyncio.Task | None = None
+        self.task: asyncio.Task | None = None
+        self.message: Message | None = None
+        self.stage = CalculationStages.queued
+        self.aggregator: CsvAggregator | None = None
+        self.rows: int | None = None
+        self.users: int | None = None
+        self.api_location: str | None = None
+        self.cancel_requested = False
+        # Set once the api has the whole file, it can't be stopped from writing it after that
+        self.upload_sent = asyncio.Event()
+
+    def progress_text(self) -> str:
+        lines = [i18n.t("translation.admin.formatted.calculation_stage").format(
+            i18n.t("translation.admin.calculation_stages." + self.stage.value)
+        )]
+        if self.download is not None:
+            lines.append(download_progress_text(self.download))
+        rows = self.aggregator.rows if self.aggregator is not None else self.rows
+        if rows is not None:
+            lines.append(i18n.t("translation.admin.formatted.calculation_rows").format(rows))
+        if self.users is not None:
+            lines.append(i18n.t("translation.admin.formatted.calculation_users").format(self.users))
+        return "\n".join(lines)
+
+    def is_cancellable(self) -> bool:
+        if self.stage == CalculationStages.ingesting and self.upload_sent.is_set():
+            return False
+        return self.stage in [
+            CalculationStages.queued,
+            CalculationStages.downloading,
+            CalculationStages.ingesting,
+            CalculationStages.calculating
+        ]
+
+    def cancel(self) -> bool:
+        """Returns False if the job has gone too far to be cancelled"""
+        if not self.is_cancellable():
+            return False
+
+        self.cancel_requested = True
+        if self.task is not None:
+            self.task.cancel()
+        return True
+
+
+# Admin chat id -> calculation started from it. Only one calculation runs at a time, they share the same data
+calculation_jobs: dict[int, CalculationJob] = {}
+
+
+def cancel_calculation_keyboard():
+    return InlineKeyboardMarkup(
+        [
+            [
+                InlineKeyboardButton(
+                    i18n.t("translation.cancel"),
+                    callback_data=QueryCategories.admin.value + "*" + QueryCommands.cancel_calculation.value
+                )
+            ]
+        ]
+    )
+
+
+async def _edit_progress(job: CalculationJob):
+    try:
+        await job.message.edit_text(
+            job.progress_text(),
+            reply_markup=cancel_calculation_keyboard() if job.is_cancellable() else None
+        )
+    except BadRequest as e:
+        # Mostly "message is not modified"
+        logging.debug("Failed to edit calculation progress: {:}".format(e))
+
+
+async def _read_upload_progress(api_location: str) -> dict:
+    async with httpx.AsyncClient(timeout=DownloadSettings.timeout.value) as client:
+        response = await client.get(
+            api_location +
+            "calculations/upload_progress/{}?bot_internal_id=" +
+            str(Other.bot_id.value)
+        )
+    response.raise_for_status()
+    return response.json()
+
+
+async def _report_progress(job: CalculationJob):
+    while True:
+        # Telegram doesn't like frequent edits of the same message
+        await asyncio.sleep(DownloadSettings.progress_interval.value)
+        if job.stage == CalculationStages.ingesting and job.api_location is not None:
+            try:
+                job.rows = (await _read_upload_progress(job.api_location)).get("inserted")
+            except httpx.HTTPError as e:
+                # Before the api starts writing the file and after it's done there is no progress
+                logging.debug("Failed to read upload progress: {:}".format(e))
+        await _edit_progress(job)
+
+
+async def _read_calculation_results_from_api(api_location: str) -> dict:
+    async with httpx.AsyncClient(timeout=DownloadSettings.upload_timeout.value) as client:
+        response = await client.get(
+            api_location +
+            "calculations/get_calculation_results_for_all_users/{}?bot_internal_id=" +
+            str(Other.bot_id.value)
+        )
+    response.raise_for_status()
+    return response.json()
+
+
+async def _calculate(job: CalculationJob, context: CallbackContext):
+    if job.download is not None:
+        job.stage = CalculationStages.downloading
+        # The file is parsed while it's being downloaded, so the download runs in the background
+        job.download_task = asyncio.create_task(job.download.run())
+        if not await job.download.wait_for_response():
+            job.download.raise_for_error()
+
+    job.stage = CalculationStages.ingesting
+    if os.getenv("CALCULATION_SOURCE", "api") == "csv":
+        # Sum the file right here, without storing its rows in the api db
+        job.aggregator = CsvAggregator(Other.bot_id.value)
+        await aggregate_csv_file(Other.bot_id.value, "newest.csv", download=job.download, aggregator=job.aggregator)
+        await context.bot.send_message(
+            job.chat_id,
+            i18n.t("translation.admin.formatted.csv_aggregate_result").format(
+                job.aggregator.rows, job.aggregator.rejected
+            )
+        )
+
+        # Keys are strings, as if the results came through json
+        calculation_results = {str(friend_id): sums for friend_id, sums in job.aggregator.results().items()}
+    else:
+        api_location = os.getenv("API_LOCATION")
+        if api_location is None:
+            await context.bot.send_message(job.chat_id, i18n.t("translation.wrong_env_config"))
+            raise Exception("API_LOCATION is not set")
+        job.api_location = api_location
+
+        # The api writes the file to its db. It prunes the previous one itself,
+        # unless the ingest is incremental and there is a previous upload to build on
+        try:
+            ingest_result = await upload_csv_file(
+                api_location,
+                "newest.csv",
+                incremental=os.getenv("CSV_INGEST_MODE", "full") == "incremental",
+                download=job.download,
+                sent=job.upload_sent
+            )
+        except httpx.HTTPStatusError as e:
+            if e.response.status_code == 409:
+                # A cancelled calculation left the api writing its file
+                await context.bot.send_message(job.chat_id, i18n.t("translation.admin.api_is_writing_previous_file"))
+            raise
+        job.rows = ingest_result.get("inserted")
+        await context.bot.send_message(
+            job.chat_id,
+            i18n.t("translation.admin.formatted.csv_ingest_result").format(
+                ingest_result.get("inserted"), ingest_result.get("rejected"), ingest_result.get("skipped")
+            )
+        )
+
+        job.stage = CalculationStages.calculating
+        try:
+            calculation_results = await _read_calculation_results_from_api(api_location)
+        except httpx.HTTPError:
+            await context.bot.send_message(job.chat_id, i18n.t("translation.admin.error_during_api_calculations"))
+            raise
+
+    if job.download_task is not None:
+        await job.download_task
+
+    # From now on the job can't be cancelled, balances are written no matter what
+    job.stage = CalculationStages.cashback
+    await _edit_progress(job)
+    # Calculate with ratios for this user, save to the db. Users without results are zeroed in the same bulk write
+    cashback_result = await calculate_cashback_for_all_users(calculation_results, job.id)
+    job.users = cashback_result.get("updated")
+    await context.bot.send_message(
+        job.chat_id,
+        i18n.t("translation.admin.formatted.cashback_result").format(
+            cashback_result.get("updated"), cashback_result.get("skipped")
+        )
+    )
+
+    job.stage = CalculationStages.withdraw_list
+    await context.bot.send_message(job.chat_id, i18n.t("translation.admin.calculation_successful"))
+    await context.bot.send_message(
+        job.chat_id,
+        await generate_list_of_current_withdraws(job.chat_id, context, calculation_results),
+        ParseMode.HTML
+    )
+
+
+async def run_calculation(context: CallbackContext):
+    """Job queue callback, context.job.data is the CalculationJob"""
+    job: CalculationJob = context.job.data
+    job.task = asyncio.current_task()
+    job.message = await context.bot.send_message(
+        job.chat_id,
+        job.progress_text(),
+        reply_markup=cancel_calculation_keyboard()
+    )
+    progress_task = asyncio.create_task(_report_progress(job))
+
+    try:
+        if job.cancel_requested:
+            raise asyncio.CancelledError()
+        await _calculate(job, context)
+        job.stage = CalculationStages.finished
+    except asyncio.CancelledError:
+        job.stage = CalculationStages.cancelled
+        await context.bot.send_message(job.chat_id, i18n.t("translation.cancelled"))
+    except Exception as e:
+        logging.error("Calculation failed: {:}".format(e))
+        job.stage = CalculationStages.failed
+        await context.bot.send_message(job.chat_id, i18n.t("translation.error"))
+    finally:
+        progress_task.cancel()
+        if job.download_task is not None and not job.download_task.done():
+            job.download_task.cancel()
+        calculation_jobs.pop(job.chat_id, None)
+
+    await _edit_progress(job)
+
+
+def is_calculation_running() -> bool:
+    return len(calculation_jobs) > 0
+
+
+def start_calculation(context: CallbackContext, chat_id: int, download: StreamingDownload | None = None) -> bool:
+    """Schedules the calculation on the job queue, returns False if another one is still running"""
+    if is_calculation_running():
+        return False
+
+    job = CalculationJob(chat_id, download)
+    calculation_jobs[chat_id] = job
+    context.job_queue.run_once(run_calculation, 0, data=job, name="calculation", chat_id=chat_id)
+    return True
+
+
+def cancel_calculation(chat_id: int) -> bool:
+    job = calculation_jobs.get(chat_id)
+    if job is None:
+        return False
+
+    return job.cancel()
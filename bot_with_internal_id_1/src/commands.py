@@ -7,22 +7,22 @@ from telegram.ext import CallbackContext, ConversationHandler
 
 from .bot_notifications import notify_about_new_user
 from .static.const import QueryCommands, CommandsWithDescriptions, CommandsRelated
-from .middleware import main_handler, critical_checks, is_chat_exists
-from .db import create_chat, change_chat_language, read_bid, update_registered_user, read_chat
+from .middleware import main_handler, critical_checks, is_chat_exists, get_chat, set_chat_fields
+from .db import create_chat, read_bid, update_open_tickets_language, update_registered_user
 
 
 async def start_command(update: Update, context: CallbackContext):
-    if not critical_checks(update.effective_chat.id):
+    if not await critical_checks(update.effective_chat.id):
         return
 
     # If user already interacted with the bot before
-    if is_chat_exists(update.effective_chat.id):
+    if await is_chat_exists(update.effective_chat.id):
         # Checks that have to be done every update
-        main_handler(update.effective_chat.id, update.effective_user.first_name, update.effective_user.username)
+        await main_handler(update.effective_chat.id, update.effective_user.first_name, update.effective_user.username)
         await help_command(update, context)
     # If user is not in the database (most certainly sent first ever message to the bot)
     else:
-        create_chat(update.effective_chat.id)
+        await create_chat(update.effective_chat.id)
         await context.bot.send_message(update.effective_chat.id, i18n.t("translation.first_interaction"))
 
 
@@ -53,9 +53,9 @@ async def start_command(update: Update, context: CallbackContext):
 
 async def help_command(update: Update, context: CallbackContext):
     # Checks that have to be done every update
-    main_handler(update.effective_chat.id, update.effective_user.first_name, update.effective_user.username)
+    await main_handler(update.effective_chat.id, update.effective_user.first_name, update.effective_user.username)
 
-    if not critical_checks(update.effective_chat.id):
+    if not await critical_checks(update.effective_chat.id):
         return
 
     await context.bot.send_message(
@@ -72,9 +72,9 @@ async def help_command(update: Update, context: CallbackContext):
 
 async def cancel_command(update: Update, context: CallbackContext):
     # Checks that have to be done every update
-    main_handler(update.effective_chat.id, update.effective_user.first_name, update.effective_user.username)
+    await main_handler(update.effective_chat.id, update.effective_user.first_name, update.effective_user.username)
 
-    if not critical_checks(update.effective_chat.id):
+    if not await critical_checks(update.effective_chat.id):
         return
 
     await context.bot.send_message(update.effective_chat.id, i18n.t("translation.nothing_to_cancel"))
@@ -90,9 +90,9 @@ class SetData:
 
     async def handle_name(self, update: Update, context: CallbackContext):
         # Checks that have to be done every update
-        main_handler(update.effective_chat.id, update.effective_user.first_name, update.effective_user.username)
+        await main_handler(update.effective_chat.id, update.effective_user.first_name, update.effective_user.username)
 
-        if not critical_checks(update.effective_chat.id):
+        if not await critical_checks(update.effective_chat.id):
             return
 
         await context.bot.send_message(update.effective_chat.id, i18n.t("translation.send_your_full_name"))
@@ -101,9 +101,9 @@ class SetData:
 
     async def binance_id_handling(self, update: Update, context: CallbackContext):
         # Checks that have to be done every update
-        main_handler(update.effective_chat.id, update.effective_user.first_name, update.effective_user.username)
+        await main_handler(update.effective_chat.id, update.effective_user.first_name, update.effective_user.username)
 
-        if not critical_checks(update.effective_chat.id):
+        if not await critical_checks(update.effective_chat.id):
             return
 
         if re.fullmatch(r"[a-zA-Z\u0400-\u04FF ]+", update.message.text) is not None:
@@ -117,12 +117,12 @@ class SetData:
 
     async def wallet_handling(self, update: Update, context: CallbackContext):
         # Checks that have to be done every update
-        main_handler(update.effective_chat.id, update.effective_user.first_name, update.effective_user.username)
+        await main_handler(update.effective_chat.id, update.effective_user.first_name, update.effective_user.username)
 
-        if not critical_checks(update.effective_chat.id):
+        if not await critical_checks(update.effective_chat.id):
             return
 
-        user_with_bid = read_bid(int(update.message.text))
+        user_with_bid = await read_bid(int(update.message.text))
 
         if user_with_bid is None or user_with_bid.get("chat_id") == update.effective_chat.id:
             self.data[update.effective_chat.id]["bid"] = update.message.text
@@ -138,9 +138,9 @@ class SetData:
 
     async def finish(self, update: Update, context: CallbackContext):
         # Checks that have to be done every update
-        main_handler(update.effective_chat.id, update.effective_user.first_name, update.effective_user.username)
+        await main_handler(update.effective_chat.id, update.effective_user.first_name, update.effective_user.username)
 
-        if not critical_checks(update.effective_chat.id):
+        if not await critical_checks(update.effective_chat.id):
             self.data[update.effective_chat.id] = {}
             return
 
@@ -152,7 +152,7 @@ class SetData:
                     CommandsWithDescriptions.my_data.value.get(CommandsRelated.command_name.value)
                 )
             )
-            update_registered_user(
+            await update_registered_user(
                 update.effective_chat.id,
                 self.data[update.effective_chat.id].get("name"),
                 int(self.data[update.effective_chat.id].get("bid")),
@@ -161,7 +161,6 @@ class SetData:
             await notify_about_new_user(
                 self.data[update.effective_chat.id].get("name"),
                 int(self.data[update.effective_chat.id].get("bid")),
-                context,
                 update.effective_user.username
             )
             self.data[update.effective_chat.id] = {}
@@ -172,9 +171,9 @@ class SetData:
 
     async def cancel(self, update: Update, context: CallbackContext):
         # Checks that have to be done every update
-        main_handler(update.effective_chat.id, update.effective_user.first_name, update.effective_user.username)
+        await main_handler(update.effective_chat.id, update.effective_user.first_name, update.effective_user.username)
 
-        if not critical_checks(update.effective_chat.id):
+        if not await critical_checks(update.effective_chat.id):
             return
 
         self.data[update.effective_chat.id] = {}
@@ -184,12 +183,12 @@ class SetData:
 
 async def my_data_command(update: Update, context: CallbackContext):
     # Checks that have to be done every update
-    main_handler(update.effective_chat.id, update.effective_user.first_name, update.effective_user.username)
+    await main_handler(update.effective_chat.id, update.effective_user.first_name, update.effective_user.username)
 
-    if not critical_checks(update.effective_chat.id):
+    if not await critical_checks(update.effective_chat.id):
         return
 
-    user = read_chat(update.effective_chat.id)
+    user = await get_chat(update.effective_chat.id)
     name = user.get("real_name")
     bid = user.get("binance_id")
     wallet = user.get("withdraw_wallet")
@@ -215,7 +214,8 @@ async def local_query_handler(update: Update, context: CallbackContext):
     header_query = query[0]
 
     if header_query == QueryCommands.lang_code_handle.value:
-        change_chat_language(update.effective_chat.id, query[1])
+        await set_chat_fields(update.effective_chat.id, language=query[1])
+        await update_open_tickets_language(update.effective_chat.id, query[1])
         await update.callback_query.answer()
         await context.bot.delete_message(update.effective_chat.id, update.effective_message.id)
         await help_command(update, context)  # await main_menu(update, context)
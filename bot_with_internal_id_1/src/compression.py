@@ -0,0 +1,88 @@
+import asyncio
+import zipfile
+
+import zstandard
+
+from csv_common.compression import MAGIC_NUMBERS, GzipDecompressor, detect_compression, raise_if_truncated
+
+from .static.const import CsvIngestSettings, DownloadSettings
+
+
+# Names of the documents the bot accepts, compressed ones are recognized by their first bytes
+CSV_FILE_SUFFIXES = (".csv", ".csv.gz", ".gz", ".zip", ".zst", ".csv.zst")
+
+
+async def detect_file_compression(path: str, download=None) -> str | None:
+    if download is not None:
+        await download.wait_for(max(len(magic_number) for magic_number in MAGIC_NUMBERS))
+        download.raise_for_error()
+    with open(path, "rb") as f:
+        return detect_compression(f.read(4))
+
+
+async def file_blocks(path: str, download=None, block_size: int = DownloadSettings.chunk_size.value):
+    """Yields the file block by block, if it's still being downloaded, waits for the next blocks to arrive"""
+    position = 0
+    with open(path, "rb") as f:
+        while True:
+            if download is not None:
+                await download.wait_for(position + 1)
+                download.raise_for_error()
+
+            f.seek(position)
+            block = f.read(block_size)
+            if not block:
+                if download is None or download.finished:
+                    return
+                continue
+
+            position += len(block)
+            yield block
+
+
+async def _decompressed_blocks(path: str, compression: str, download=None):
+    if compression == "zip":
+        # Zip keeps the list of files at its end, so it can only be opened when it's fully downloaded
+        if download is not None:
+            await download.wait_until_finished()
+            download.raise_for_error()
+
+        with zipfile.ZipFile(path) as archive:
+            csv_files = [name for name in archive.namelist() if name.endswith(".csv")]
+            if not csv_files:
+                raise Exception("No .csv in the archive")
+            with archive.open(csv_files[0]) as f:
+                while block := await asyncio.to_thread(f.read, DownloadSettings.chunk_size.value):
+                    yield block
+    else:
+        if compression == "gzip":
+            decompressor = GzipDecompressor()
+        else:
+            decompressor = zstandard.ZstdDecompressor().decompressobj()
+
+        async for block in file_blocks(path, download):
+            yield await asyncio.to_thread(decompressor.decompress, block)
+
+        raise_if_truncated(decompressor)
+
+
+async def decompressed_csv_chunks(
+        path: str,
+        compression: str,
+        download=None,
+        chunk_size: int = CsvIngestSettings.chunk_size.value
+):
+    """Decompresses the file in a stream and yields it in chunks of about chunk_size bytes, that end with
+    a line break. The decompressed file is never written to the disk and is never in memory as a whole"""
+    buffer = b""
+    async for block in _decompressed_blocks(path, compression, download):
+        buffer += block
+        while True:
+            line_break = buffer.find(b"\n", chunk_size - 1)
+            if line_break == -1:
+                break
+            yield buffer[:line_break + 1]
+            buffer = buffer[line_break + 1:]
+
+    if buffer:
+        yield buffer
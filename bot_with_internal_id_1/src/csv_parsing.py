@@ -0,0 +1,230 @@
+import asyncio
+import io
+import logging
+import os
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+from typing import Iterable
+
+from csv_common.const import CsvColumns
+from csv_common.parsing import COMMISSION_ASSET_COLUMNS, ORDER_TYPE_KEYS, csv_parse_workers, parse_csv_row
+
+from .compression import decompressed_csv_chunks, detect_file_compression
+from .static.const import CsvIngestSettings
+
+
+class CsvAggregator:
+    """Sums commissions of the referral .csv the same way the api does, without storing the rows.
+    Keeps one accumulator per (friend, order type, asset, before or after the trial end),
+    so memory depends on the amount of users, not on the amount of rows"""
+
+    def __init__(self, bot_internal_id: int):
+        self.bot_internal_id = bot_internal_id
+        # friend id -> {(period, order type, asset): [sum, compensation]}
+        self.accumulators: dict[int, dict[tuple[str, str, str], list[float]]] = {}
+        self.rows = 0
+        self.rejected = 0
+
+    def add_document(self, document: dict):
+        self.rows += 1
+        friend_accumulators = self.accumulators.setdefault(document.get(CsvColumns.friend_id_spot.value), {})
+
+        order_type = ORDER_TYPE_KEYS.get(document.get(CsvColumns.order_type.value))
+        asset = COMMISSION_ASSET_COLUMNS.get(document.get(CsvColumns.commission_asset.value))
+        if order_type is None or asset is None:
+            return
+        asset_key, sum_field = asset
+
+        period = "after" if document.get(CsvColumns.commission_time.value) >= document.get("Date of trial end") \
+            else "before"
+        accumulator = friend_accumulators.setdefault((period, order_type, asset_key), [0.0, 0.0])
+
+        # Neumaier summation, the db sums with the extended precision too, so long sums don't drift apart
+        value = document.get(sum_field)
+        total = accumulator[0] + value
+        if abs(accumulator[0]) >= abs(value):
+            accumulator[1] += (accumulator[0] - total) + value
+        else:
+            accumulator[1] += (value - total) + accumulator[0]
+        accumulator[0] = total
+
+    def add_rows(self, csv_rows: Iterable[str]):
+        for row in csv_rows:
+            try:
+                document = parse_csv_row(self.bot_internal_id, row)
+            except (ValueError, IndexError):
+                logging.debug("Rejected csv row {:}".format(row))
+                self.rejected += 1
+                continue
+
+            if document is not None:
+                self.add_document(document)
+
+        return self
+
+    def merge(self, other: "CsvAggregator"):
+        """Adds sums of another aggregator, for example the one that has read another part of the file"""
+        self.rows += other.rows
+        self.rejected += other.rejected
+        for friend_id, other_accumulators in other.accumulators.items():
+            friend_accumulators = self.accumulators.setdefault(friend_id, {})
+            for key, (other_total, other_compensation) in other_accumulators.items():
+                accumulator = friend_accumulators.setdefault(key, [0.0, 0.0])
+                total = accumulator[0] + other_total
+                if abs(accumulator[0]) >= abs(other_total):
+                    accumulator[1] += (accumulator[0] - total) + other_total
+                else:
+                    accumulator[1] += (other_total - total) + accumulator[0]
+                accumulator[0] = total
+                accumulator[1] += other_compensation
+
+        return self
+
+    def results(self) -> dict:
+        """Same structure as the api's get_calculation_results_for_all_users"""
+        results = {}
+        for friend_id, friend_accumulators in self.accumulators.items():
+            friend_results = {
+                "sum_results_before_user_used_the_bot_for_30_days": {
+                    "spot": {},
+                    "futures": {}
+                },
+                "sum_results_after_user_used_the_bot_for_30_days": {
+                    "spot": {},
+                    "futures": {}
+                }
+            }
+            for (period, order_type, asset_key), (total, compensation) in friend_accumulators.items():
+                friend_results[f"sum_results_{period}_user_used_the_bot_for_30_days"][order_type][asset_key] = \
+                    total + compensation
+            results[friend_id] = friend_results
+
+        return results
+
+
+def split_csv_file(path: str, chunk_size: int = CsvIngestSettings.chunk_size.value) -> list[tuple[int, int]]:
+    """Splits the file into (start, end) byte ranges of about chunk_size,
+    every range starts at the beginning of a line and ends right after a line break"""
+    file_size = os.path.getsize(path)
+    ranges = []
+    with open(path, "rb") as f:
+        start = 0
+        while start < file_size:
+            f.seek(min(start + chunk_size, file_size))
+            f.readline()
+            end = min(f.tell(), file_size)
+            ranges.append((start, end))
+            start = end
+
+    return ranges
+
+
+def _read_csv_chunk(chunk: tuple[str, int, int] | bytes):
+    """Chunk is either (path, start, end) byte range of a plain .csv, or lines already decompressed from an archive"""
+    if type(chunk) == bytes:
+        return io.TextIOWrapper(io.BytesIO(chunk))
+
+    path, start, end = chunk
+    with open(path, "rb") as f:
+        f.seek(start)
+        return io.TextIOWrapper(io.BytesIO(f.read(end - start)))
+
+
+def aggregate_csv_chunk(bot_internal_id: int, chunk: tuple[str, int, int] | bytes) -> CsvAggregator:
+    """Runs in a worker process. Sums the chunk, only the sums are sent back to the main process"""
+    return CsvAggregator(bot_internal_id).add_rows(_read_csv_chunk(chunk))
+
+
+def _next_line_start(path: str, position: int, limit: int) -> int | None:
+    """Position right after the first line break at or after position, None if there is none before limit"""
+    with open(path, "rb") as f:
+        f.seek(position)
+        line_break = f.read(max(0, limit - position)).find(b"\n")
+    return position + line_break + 1 if line_break != -1 else None
+
+
+async def _growing_csv_file_ranges(path: str, download, chunk_size: int = CsvIngestSettings.chunk_size.value):
+    """Same ranges as split_csv_file gives, but for the file that is still being downloaded:
+    every range is given out as soon as it's fully on the disk"""
+    start = 0
+    while True:
+        target = start + chunk_size
+        await download.wait_for(target + 1)
+        download.raise_for_error()
+
+        end = _next_line_start(path, target, download.written)
+        while end is None and not download.finished:
+            await download.wait_for(download.written + 1)
+            download.raise_for_error()
+            end = _next_line_start(path, target, download.written)
+
+        if end is None:
+            if start < download.written:
+                yield start, download.written
+            return
+
+        yield start, end
+        start = end
+
+
+async def _csv_file_chunks(path: str, download=None):
+    compression = await detect_file_compression(path, download)
+    if compression is not None:
+        async for chunk in decompressed_csv_chunks(path, compression, download):
+            yield chunk
+    elif download is None:
+        for start, end in split_csv_file(path):
+            yield path, start, end
+    else:
+        async for start, end in _growing_csv_file_ranges(path, download):
+            yield path, start, end
+
+
+async def _map_csv_chunks(function, bot_internal_id: int, path: str, workers: int, download=None):
+    """Runs function over every chunk of the file on a pool of workers processes, yields results in the file order.
+    Keeps only a couple of chunks per worker in flight, so parsed rows of the whole file are never in memory at once.
+    With download, chunks are parsed while the rest of the file is still being downloaded.
+    Compressed files are decompressed here, workers get the decompressed lines"""
+    loop = asyncio.get_running_loop()
+    executor = ProcessPoolExecutor(workers)
+    try:
+        in_flight = deque()
+        async for chunk in _csv_file_chunks(path, download):
+            in_flight.append(loop.run_in_executor(executor, function, bot_internal_id, chunk))
+            if len(in_flight) >= workers * 2:
+                yield await in_flight.popleft()
+
+        while in_flight:
+            yield await in_flight.popleft()
+    finally:
+        # A cancelled calculation doesn't wait for the chunks that are still queued
+        executor.shutdown(wait=False, cancel_futures=True)
+
+
+async def can_read_csv_in_place(path: str, workers: int, download=None) -> bool:
+    """Whether the file can be just read line by line, without the pool of workers"""
+    return workers <= 1 and download is None and await detect_file_compression(path) is None
+
+
+async def aggregate_csv_file(
+        bot_internal_id: int,
+        path: str,
+        workers: int | None = None,
+        download=None,
+        aggregator: CsvAggregator | None = None
+) -> CsvAggregator:
+    """Sums the whole file on workers processes, merging sums of the chunks in the file order.
+    Pass the download, if the file is still being downloaded, and the aggregator, to watch its rows grow"""
+    if workers is None:
+        workers = csv_parse_workers()
+    if aggregator is None:
+        aggregator = CsvAggregator(bot_internal_id)
+    if await can_read_csv_in_place(path, workers, download):
+        # Still a thread, the whole file is read at once and the bot has to keep answering meanwhile
+        with open(path, "r") as f:
+            return await asyncio.to_thread(aggregator.add_rows, f)
+
+    async for chunk_aggregator in _map_csv_chunks(aggregate_csv_chunk, bot_internal_id, path, workers, download):
+        aggregator.merge(chunk_aggregator)
+
+    return aggregator
@@ -1,16 +1,17 @@
-from datetime import datetime, timedelta
+from datetime import datetime
 
 from bson import ObjectId
-from pymongo import MongoClient
-from pymongo.database import Database
+from motor.motor_asyncio import AsyncIOMotorClient, AsyncIOMotorDatabase
+from pymongo import UpdateMany, UpdateOne
 
 from dotenv import load_dotenv
-from typing import Any, Mapping
 
-from .static.const import CsvColumns, MinimumWithdrawValues, Other
+from .static.const import MinimumWithdrawValues, OutboxStates
+from .static.formulas import maximum_user_level
 
 import logging
 import os
+import uuid
 
 
 load_dotenv()
@@ -19,22 +20,20 @@ MONGO_URI = os.getenv("MONGO_URI")
 if MONGO_URI is None:
     logging.critical("DB URI not found. Check .env")
 else:
-    client: MongoClient[Mapping[str, Any] | Any] = MongoClient(MONGO_URI)
+    client: AsyncIOMotorClient = AsyncIOMotorClient(MONGO_URI)
     logging.info("Connected to the db successfully")
-    bot_db: Database[Mapping[str, Any] | Any] = client["refback_bot_with_id_1"]
-    api_db: Database[Mapping[str, Any] | Any] = client["refback_api"]
+    bot_db: AsyncIOMotorDatabase = client["refback_bot_with_id_1"]
 
     chat_collection = bot_db["chat"]
     support_tickets_collection = bot_db["support_tickets"]
     support_messages_collection = bot_db["support_messages"]
     restrictions_collection = bot_db["restrictions"]
+    outbox_collection = bot_db["outbox"]
 
-    csv_cache_collection = api_db["csv_cache"]
 
-
-def create_chat(chat_id: int, **kwargs):
+async def create_chat(chat_id: int, **kwargs):
     logging.debug("Checking if chat with id {:} exists".format(chat_id))
-    chat = read_chat(chat_id)
+    chat = await read_chat(chat_id)
     if chat is None:
         logging.debug("Started creating chat with id {:}".format(chat_id))
 
@@ -47,7 +46,7 @@ def create_chat(chat_id: int, **kwargs):
             "available_to_withdraw_bnb": 0.0
         }
 
-        result = chat_collection.insert_one(
+        result = await chat_collection.insert_one(
             {**arguments, **kwargs}
         )
         logging.debug("Finished creating chat with id {:}".format(chat_id))
@@ -58,27 +57,69 @@ def create_chat(chat_id: int, **kwargs):
     return result
 
 
-def read_chat(chat_id: int):
+async def read_chat(chat_id: int):
     logging.debug("Started reading chat with id {:}".format(chat_id))
-    result = chat_collection.find_one({"chat_id": chat_id}, {})
+    result = await chat_collection.find_one({"chat_id": chat_id}, {})
     logging.debug("Finished reading chat with id {:}".format(chat_id))
 
     return result
 
 
-def change_chat_language(chat_id: int, new_lang_code: str):
+async def read_chat_with_restrictions(chat_id: int):
+    """Reads chat and its restrictions in one round-trip. Returns (chat, restrictions), both can be None"""
+    logging.debug("Started reading chat with restrictions with id {:}".format(chat_id))
+    chats = await chat_collection.aggregate(
+        [
+            {"$match": {"chat_id": chat_id}},
+            {"$limit": 1},
+            {
+                "$lookup": {
+                    "from": restrictions_collection.name,
+                    "localField": "chat_id",
+                    "foreignField": "chat_id",
+                    "as": "restrictions",
+                }
+            },
+        ]
+    ).to_list(1)
+    chat = chats[0] if chats else None
+
+    if chat is None:
+        # Chat isn't created yet, but the restriction still may exist
+        restrictions = await read_restrictions_for_tg_id(chat_id)
+    else:
+        restrictions = chat.pop("restrictions")
+        restrictions = restrictions[0] if restrictions else None
+    logging.debug("Finished reading chat with restrictions with id {:}".format(chat_id))
+
+    return chat, restrictions
+
+
+async def update_chat_fields(chat_id: int, fields: dict):
+    return await chat_collection.update_one({"chat_id": chat_id}, {"$set": fields})
+
+
+async def update_open_tickets_language(chat_id: int, language: str):
+    return await support_tickets_collection.update_many(
+        {"chat_id": chat_id, "state": {"$ne": "closed"}}, {"$set": {"language": language}}
+    )
+
+
+async def change_chat_language(chat_id: int, new_lang_code: str):
     logging.debug("Started changing chat language in id {:} to {:}".format(chat_id, new_lang_code))
-    result = chat_collection.update_one({"chat_id": chat_id}, {"$set": {"language": new_lang_code}})
+    result = await chat_collection.update_one({"chat_id": chat_id}, {"$set": {"language": new_lang_code}})
     logging.debug("Finished changing chat language in id {:} to {:}".format(chat_id, new_lang_code))
 
     return result
 
 
-def create_support_ticket(chat_id: int, heading: str):
-    return support_tickets_collection.insert_one(
+async def create_support_ticket(chat_id: int, heading: str, language: str | None = None):
+    """The language of the user is kept in the ticket, so messages can be relayed to the user without reading the chat"""
+    return await support_tickets_collection.insert_one(
         {
             "chat_id": chat_id,
             "heading": heading,
+            "language": language,
             "is_selected_by_user": True,
             "selected_by_support": None,
             "state": "new",
@@ -87,20 +128,20 @@ def create_support_ticket(chat_id: int, heading: str):
     )
 
 
-def read_open_tickets(chat_id: int):
+async def read_open_tickets(chat_id: int):
     """Finds all open user tickets"""
     return support_tickets_collection.find(
         {"chat_id": chat_id, "state": {"$ne": "closed"}}, {}
     )
 
 
-def read_ticket(_id: ObjectId | str):
-    return support_tickets_collection.find_one(
+async def read_ticket(_id: ObjectId | str):
+    return await support_tickets_collection.find_one(
         {"_id": _id if type(_id) == ObjectId else ObjectId(_id)}
     )
 
 
-def read_selected_ticket(chat_id: int, from_type, **kwargs):
+async def read_selected_ticket(chat_id: int, from_type, **kwargs):
     if from_type not in ["user", "support_agent"]:
         raise Exception("Unknown user_type")
 
@@ -109,7 +150,7 @@ def read_selected_ticket(chat_id: int, from_type, **kwargs):
         "is_selected_by_user" if from_type == "user" else "selected_by_support"
     )
 
-    return support_tickets_collection.find_one(
+    return await support_tickets_collection.find_one(
         {
             _chat_id: chat_id,
             "state": "in_progress",
@@ -119,17 +160,17 @@ def read_selected_ticket(chat_id: int, from_type, **kwargs):
     )
 
 
-def read_all_admins(level: int):
+async def read_all_admins(level: int):
     """Finds all admins that are higher than level x"""
     return chat_collection.find({"admin_level": {"$gte": level}}, {})
 
 
-def read_all_new_tickets():
+async def read_all_new_tickets():
     """Finds all tickets with a status new (used for admins)"""
     return support_tickets_collection.find({"state": "new"}, {})
 
 
-def read_agent_tickets(tg_id: int, list_closed=False, **kwargs):
+async def read_agent_tickets(tg_id: int, list_closed=False, **kwargs):
     """Finds all tickets managed by selected support agent"""
     params = {"support_agent": tg_id}
 
@@ -139,8 +180,8 @@ def read_agent_tickets(tg_id: int, list_closed=False, **kwargs):
     return support_tickets_collection.find(params, kwargs)
 
 
-def close_support_ticket(ticket_id: str | ObjectId):
-    return support_tickets_collection.update_one(
+async def close_support_ticket(ticket_id: str | ObjectId):
+    return await support_tickets_collection.update_one(
         {
             "_id": ObjectId(ticket_id) if type(ticket_id) == str else ticket_id,
             "state": {"$ne": "closed"},
@@ -156,8 +197,8 @@ def close_support_ticket(ticket_id: str | ObjectId):
     )
 
 
-def unselect_all_tickets(user_tg_id: int, side):
-    return support_tickets_collection.update_many(
+async def unselect_all_tickets(user_tg_id: int, side):
+    return await support_tickets_collection.update_many(
         {
             "state": {"$ne": "closed"},
             "chat_id" if side == "user" else "support_agent": user_tg_id,
@@ -174,11 +215,11 @@ def unselect_all_tickets(user_tg_id: int, side):
     )
 
 
-def select_support_ticket(ticket_id: str | ObjectId, user_tg_id: int, side: str):
+async def select_support_ticket(ticket_id: str | ObjectId, user_tg_id: int, side: str):
     """Selects given ticket, unselects all others"""
-    unselect_all_tickets(user_tg_id, side)
+    await unselect_all_tickets(user_tg_id, side)
 
-    return support_tickets_collection.update_one(
+    return await support_tickets_collection.update_one(
         {
             "_id": ObjectId(ticket_id) if type(ticket_id) == str else ticket_id,
             "state": {"$ne": "closed"},
@@ -195,10 +236,10 @@ def select_support_ticket(ticket_id: str | ObjectId, user_tg_id: int, side: str)
     )
 
 
-def assign_ticket_to_support_agent(support_agent_tg_id: int, ticket_id: ObjectId | str):
+async def assign_ticket_to_support_agent(support_agent_tg_id: int, ticket_id: ObjectId | str):
     """Changes state of the selected ticket, as well as adds a value that leads to current support agent that's
     responsible for this ticket"""
-    return support_tickets_collection.update_one(
+    return await support_tickets_collection.update_one(
         {
             "_id": ObjectId(ticket_id) if type(ticket_id) == str else ticket_id,
             "state": "new",
@@ -207,38 +248,47 @@ def assign_ticket_to_support_agent(support_agent_tg_id: int, ticket_id: ObjectId
     )
 
 
-def add_message_to_the_ticket(formatted_message, chat_id, from_type):
+async def add_message_to_the_ticket(formatted_message, chat_id, from_type, ticket=None):
+    """Returns the saved message with its _id. The selected ticket is read, unless it's given"""
     if from_type not in ["user", "support_agent"]:
         raise Exception("Unknown user_type")
 
-    ticket = read_selected_ticket(chat_id, from_type)
+    if ticket is None:
+        ticket = await read_selected_ticket(chat_id, from_type)
 
-    return support_messages_collection.insert_one(
-        {
-            "ticket_id": ticket.get("_id"),
-            "issuer_tg_id": ticket.get("chat_id"),
-            **formatted_message,
-        }
-    )
+    message = {
+        "ticket_id": ticket.get("_id"),
+        "issuer_tg_id": ticket.get("chat_id"),
+        **formatted_message,
+    }
+    await support_messages_collection.insert_one(message)
+    return message
 
 
-def read_ticket_messages(chat_id, from_type, reverse=False):
+async def read_ticket_messages(chat_id, from_type, reverse=False):
     if from_type not in ["user", "support_agent"]:
         raise Exception("Unknown user_type")
 
-    ticket = read_selected_ticket(chat_id, from_type)
+    ticket = await read_selected_ticket(chat_id, from_type)
 
     return support_messages_collection.find(
         {"ticket_id": ticket.get("_id"), "issuer_tg_id": ticket.get("chat_id")}, {}
     ).sort("date", 1 if not reverse else -1)
 
 
-def update_tg_nicknames(tg_id: int, name: str, username: str):
-    return chat_collection.update_one({"chat_id": tg_id}, {"$set": {"tg_name": name, "tg_link": username}})
+async def update_tg_nicknames(nicknames: dict[int, tuple[str, str]]):
+    """Writes (name, username) of every given chat in one unordered bulk write"""
+    return await chat_collection.bulk_write(
+        [
+            UpdateOne({"chat_id": tg_id}, {"$set": {"tg_name": name, "tg_link": username}})
+            for tg_id, (name, username) in nicknames.items()
+        ],
+        ordered=False
+    )
 
 
-def update_registered_user(tg_id: int, real_name: str, bid: int, wallet: str):
-    return chat_collection.update_one(
+async def update_registered_user(tg_id: int, real_name: str, bid: int, wallet: str):
+    return await chat_collection.update_one(
         {"chat_id": tg_id},
         {
             "$set": {
@@ -251,8 +301,8 @@ def update_registered_user(tg_id: int, real_name: str, bid: int, wallet: str):
     )
 
 
-def update_profit_values_by_tg_id(tg_id: int, usdt: float, bnb: float):
-    return chat_collection.update_one(
+async def update_profit_values_by_tg_id(tg_id: int, usdt: float, bnb: float):
+    return await chat_collection.update_one(
         {"chat_id": tg_id},
         {
             "$set": {
@@ -263,101 +313,166 @@ def update_profit_values_by_tg_id(tg_id: int, usdt: float, bnb: float):
     )
 
 
-def prune_withdraw_records():
-    return chat_collection.update_many(
-        {
-            "$or": [
+def _not_null_withdraw_amounts_filter():
+    return {
+        "$or": [
+            {
+                "available_to_withdraw_usdt": {
+                    "$gte": MinimumWithdrawValues.usdt.value
+                }
+            },
+            {
+                "available_to_withdraw_bnb": {
+                    "$gte": MinimumWithdrawValues.bnb.value
+                }
+            }
+        ]
+    }
+
+
+async def replace_profit_values_in_bulk(profit_values: list[tuple[int, float, float]], calculation_id: str):
+    """Takes (tg_id, usdt, bnb) for every user, writes all of them and zeroes withdraw values of everybody else
+    in one unordered bulk write, so a cancelled or failed calculation can't leave the balances pruned but not written.
+    calculation_id is kept with the values, payoff notifications are sent once per calculation"""
+    updated_chat_ids = [tg_id for tg_id, _, _ in profit_values]
+    return await chat_collection.bulk_write(
+        [
+            UpdateMany(
+                {**_not_null_withdraw_amounts_filter(), "chat_id": {"$nin": updated_chat_ids}},
                 {
-                    "available_to_withdraw_usdt": {
-                        "$gte": MinimumWithdrawValues.usdt.value
+                    "$set": {
+                        "available_to_withdraw_usdt": 0.0,
+                        "available_to_withdraw_bnb": 0.0
                     }
-                },
+                }
+            )
+        ] +
+        [
+            UpdateOne(
+                {"chat_id": tg_id},
                 {
-                    "available_to_withdraw_bnb": {
-                        "$gte": MinimumWithdrawValues.bnb.value
+                    "$set": {
+                        "available_to_withdraw_usdt": usdt,
+                        "available_to_withdraw_bnb": bnb,
+                        "payoff_calculation_id": calculation_id
                     }
                 }
-            ]
-        },
-        {
-            "$set": {
-                "available_to_withdraw_usdt": 0.0,
-                "available_to_withdraw_bnb": 0.0
-            }
-        }
+            )
+            for tg_id, usdt, bnb in profit_values
+        ],
+        ordered=False
     )
 
 
-def read_all_users_with_not_null_withdraw_amounts():
-    return chat_collection.find(
-        {
-            "$or": [
-                {
-                    "available_to_withdraw_usdt": {
-                        "$gte": MinimumWithdrawValues.usdt.value
-                    }
-                },
-                {
-                    "available_to_withdraw_bnb": {
-                        "$gte": MinimumWithdrawValues.bnb.value
-                    }
-                }
-            ]
-        }
-    ).sort("available_to_withdraw_usdt", -1)
+async def read_all_users_with_not_null_withdraw_amounts():
+    return chat_collection.find(_not_null_withdraw_amounts_filter()).sort("available_to_withdraw_usdt", -1)
 
 
-def read_bid(bid: int):
-    return chat_collection.find_one({"binance_id": bid})
+async def read_bid(bid: int):
+    return await chat_collection.find_one({"binance_id": bid})
 
 
-def write_lines_from_csv(bot_internal_id: int, string_csv_rows: str):
-    list_csv_rows = string_csv_rows.split("\n")
-    documents_to_insert = []
-    for row in list_csv_rows:
-        line_elements: list = row.split(",")
-        # [1:-1:] To delete ""
-        if len(line_elements) > 1 and line_elements[1][1:-1:].isdigit() is True:
-            documents_to_insert.append(
-                {
-                    CsvColumns.order_type.value: line_elements[0][1:-1:],
-                    CsvColumns.friend_id_spot.value: int(line_elements[1][1:-1:]),
-                    CsvColumns.friend_id_sub_spot.value: line_elements[2][1:-1:],
-                    CsvColumns.commission_asset.value: line_elements[3][1:-1:],
-                    CsvColumns.coin_commission_earned.value: float(line_elements[4][1:-1:]),
-                    CsvColumns.usdt_commission_earned.value: float(line_elements[5][1:-1:]),
-                    CsvColumns.commission_time.value: datetime.strptime(line_elements[6][1:-1:], "%Y-%m-%d %H:%M:%S"),
-                    CsvColumns.registration_time.value: datetime.strptime(line_elements[7][1:-1:], "%Y-%m-%d %H:%M:%S"),
-                    CsvColumns.referral_id.value: str(line_elements[8][1:-1:]).rstrip("\n"),
-                    "Internal ID": bot_internal_id,
-                    "Date of trial end": datetime.strptime(line_elements[7][1:-1:], "%Y-%m-%d %H:%M:%S") + timedelta(30)
-                }
-            )
-    return csv_cache_collection.insert_many(documents_to_insert)
+async def read_users_by_bids(bids: list[int]):
+    return chat_collection.find(
+        {"binance_id": {"$in": bids}},
+        {"chat_id": 1, "binance_id": 1, "user_level": 1}
+    )
 
 
-def increase_level(binance_id: int):
-    user = read_bid(binance_id)
+async def increase_level(binance_id: int):
+    user = await read_bid(binance_id)
     if user is None:
         return
     current_level = user.get("user_level", 1)
-    if current_level < Other.maximum_user_level.value:
-        return chat_collection.update_one({"binance_id": binance_id}, {"$set": {"user_level": current_level + 1}})
+    if current_level < maximum_user_level:
+        return await chat_collection.update_one({"binance_id": binance_id}, {"$set": {"user_level": current_level + 1}})
 
 
-def decrease_level(binance_id: int):
-    user = read_bid(binance_id)
+async def decrease_level(binance_id: int):
+    user = await read_bid(binance_id)
     if user is None:
         return
     current_level = user.get("user_level", 1)
     if current_level > 1:
-        return chat_collection.update_one({"binance_id": binance_id}, {"$set": {"user_level": current_level - 1}})
+        return await chat_collection.update_one({"binance_id": binance_id}, {"$set": {"user_level": current_level - 1}})
 
 
 # TODO: add the ability to add admins of different levels
-def add_new_admin():
+async def add_new_admin():
     raise NotImplementedError
 
 
-def read_restrictions_for_tg_id(chat_id: int):
-    return restrictions_collection.find_one({"chat_id": chat_id}, {})
+async def read_restrictions_for_tg_id(chat_id: int):
+    return await restrictions_collection.find_one({"chat_id": chat_id}, {})
+
+
+async def write_outbox_messages(messages: list[dict]):
+    """Adds messages to the outbox in one unordered bulk write. A message with the dedupe key,
+    that is already in the outbox, isn't added again, whatever state it's in"""
+    if not messages:
+        return
+
+    now = datetime.now()
+    return await outbox_collection.bulk_write(
+        [
+            UpdateOne(
+                {"dedupe_key": message.get("dedupe_key")},
+                {
+                    "$setOnInsert": {
+                        **message,
+                        "state": OutboxStates.pending.value,
+                        "attempts": 0,
+                        "next_attempt": now,
+                        "created": now
+                    }
+                },
+                upsert=True
+            )
+            for message in messages
+        ],
+        ordered=False
+    )
+
+
+async def claim_outbox_messages(limit: int) -> list[dict]:
+    """Moves up to limit due pending messages to the sending state and returns them"""
+    ids = [
+        message.get("_id") async for message in outbox_collection.find(
+            {"state": OutboxStates.pending.value, "next_attempt": {"$lte": datetime.now()}},
+            {"_id": 1}
+        ).sort("next_attempt", 1).limit(limit)
+    ]
+    if not ids:
+        return []
+
+    # Only the messages that are still pending get the claim, so none of them is sent twice
+    claim = uuid.uuid4().hex
+    await outbox_collection.update_many(
+        {"_id": {"$in": ids}, "state": OutboxStates.pending.value},
+        {"$set": {"state": OutboxStates.sending.value, "claim": claim, "updated": datetime.now()}}
+    )
+    return await outbox_collection.find({"claim": claim}).to_list(None)
+
+
+async def update_outbox_message(_id: ObjectId, fields: dict):
+    return await outbox_collection.update_one({"_id": _id}, {"$set": {**fields, "updated": datetime.now()}})
+
+
+async def interrupt_sending_outbox_messages():
+    """Messages, that were being sent when the bot stopped, may have been delivered already.
+    They are never sent again, only marked"""
+    return await outbox_collection.update_many(
+        {"state": OutboxStates.sending.value},
+        {"$set": {"state": OutboxStates.interrupted.value, "updated": datetime.now()}}
+    )
+
+
+async def count_outbox_states(dedupe_keys: list[str]) -> dict[str, int]:
+    """State -> amount of the messages with these dedupe keys"""
+    states = {}
+    async for state in outbox_collection.aggregate([
+        {"$match": {"dedupe_key": {"$in": dedupe_keys}}},
+        {"$group": {"_id": "$state", "amount": {"$sum": 1}}}
+    ]):
+        states[state.get("_id")] = state.get("amount")
+    return states
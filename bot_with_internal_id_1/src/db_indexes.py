@@ -0,0 +1,113 @@
+import logging
+from datetime import datetime
+from typing import Any, Mapping
+
+from bson import ObjectId
+from pymongo import ASCENDING, IndexModel
+from pymongo.errors import OperationFailure
+
+from .db import chat_collection, outbox_collection, restrictions_collection, support_messages_collection, \
+    support_tickets_collection
+
+
+COLLECTION_INDEXES = [
+    (chat_collection, [
+        IndexModel([("chat_id", ASCENDING)], name="chat_id", unique=True),
+        IndexModel([("binance_id", ASCENDING)], name="binance_id"),
+        IndexModel([("admin_level", ASCENDING)], name="admin_level"),
+    ]),
+    (support_tickets_collection, [
+        IndexModel([("chat_id", ASCENDING), ("state", ASCENDING)], name="chat_id_state"),
+        IndexModel([("support_agent", ASCENDING), ("state", ASCENDING)], name="support_agent_state"),
+        IndexModel([("state", ASCENDING)], name="state"),
+    ]),
+    (support_messages_collection, [
+        IndexModel(
+            [("ticket_id", ASCENDING), ("issuer_tg_id", ASCENDING), ("date", ASCENDING)],
+            name="ticket_id_issuer_tg_id_date"
+        ),
+    ]),
+    (restrictions_collection, [
+        IndexModel([("chat_id", ASCENDING)], name="chat_id"),
+    ]),
+    (outbox_collection, [
+        IndexModel([("dedupe_key", ASCENDING)], name="dedupe_key", unique=True),
+        IndexModel([("state", ASCENDING), ("next_attempt", ASCENDING)], name="state_next_attempt"),
+        IndexModel([("claim", ASCENDING)], name="claim"),
+    ]),
+]
+
+
+async def create_indexes():
+    """Creates indexes for every query shape of the bot, if they don't exist yet"""
+    for collection, indexes in COLLECTION_INDEXES:
+        for index in indexes:
+            try:
+                await collection.create_indexes([index])
+            except OperationFailure as e:
+                # Most likely duplicated chat_id documents, that prevent the unique index from being built
+                logging.critical("Failed to create index {:} on {:}: {:}".format(
+                    index.document.get("name"), collection.name, e
+                ))
+
+    logging.info("Bot db indexes are in place")
+
+
+def _collect_used_indexes(plan: Mapping[str, Any] | list | Any) -> list[str]:
+    """Walks through the explain output, returns names of used indexes, or COLLSCAN for collection scans.
+    Same as _collect_used_indexes of the api, keep them in sync"""
+    used_indexes = []
+
+    if type(plan) == list:
+        for node in plan:
+            used_indexes.extend(_collect_used_indexes(node))
+    elif isinstance(plan, Mapping):
+        if plan.get("stage") == "COLLSCAN":
+            used_indexes.append("COLLSCAN")
+        if plan.get("indexName") is not None:
+            used_indexes.append(plan.get("indexName"))
+        for value in plan.values():
+            used_indexes.extend(_collect_used_indexes(value))
+
+    return used_indexes
+
+
+async def check_query_plans():
+    """Explains one query of every shape the bot uses, logs the ones that still scan the whole collection.
+    Runs only once, at startup, so a query shape that loses its index later is noticed on the next restart"""
+    queries = {
+        "read_chat": chat_collection.find({"chat_id": 0}),
+        "read_bid": chat_collection.find({"binance_id": 0}),
+        "read_all_admins": chat_collection.find({"admin_level": {"$gte": 1}}),
+        "read_selected_ticket (user)": support_tickets_collection.find(
+            {"chat_id": 0, "state": "in_progress", "is_selected_by_user": True}
+        ),
+        "read_selected_ticket (support_agent)": support_tickets_collection.find(
+            {"support_agent": 0, "state": "in_progress", "selected_by_support": 0}
+        ),
+        "read_agent_tickets": support_tickets_collection.find({"support_agent": 0, "state": {"$ne": "closed"}}),
+        "read_all_new_tickets": support_tickets_collection.find({"state": "new"}),
+        "read_ticket_messages": support_messages_collection.find(
+            {"ticket_id": ObjectId(), "issuer_tg_id": 0}
+        ).sort("date", 1),
+        "read_restrictions_for_tg_id": restrictions_collection.find({"chat_id": 0}),
+        "claim_outbox_messages": outbox_collection.find(
+            {"state": "pending", "next_attempt": {"$lte": datetime.now()}}
+        ).sort("next_attempt", 1),
+    }
+
+    collection_scans = []
+    for query_name, cursor in queries.items():
+        used_indexes = _collect_used_indexes((await cursor.explain()).get("queryPlanner", {}))
+        logging.debug("Query {:} uses {:}".format(query_name, used_indexes))
+        if "COLLSCAN" in used_indexes:
+            logging.warning("Query {:} falls back to a collection scan".format(query_name))
+            collection_scans.append(query_name)
+
+    return collection_scans
+
+
+async def ensure_indexes():
+    """Called from post_init, nothing checks the indexes or the query plans after the bot has started"""
+    await create_indexes()
+    await check_query_plans()
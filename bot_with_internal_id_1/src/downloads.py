@@ -0,0 +1,92 @@
+import asyncio
+import logging
+
+import httpx
+import i18n
+
+from .static.const import DownloadSettings
+
+
+def _error_description(e: Exception) -> str:
+    if isinstance(e, httpx.HTTPStatusError):
+        return "status code {:}".format(e.response.status_code)
+    return type(e).__name__
+
+
+class StreamingDownload:
+    """Downloads url to path chunk by chunk. The file can be read while it's still being written:
+    written is the amount of bytes that are already on the disk"""
+
+    def __init__(self, url: str, path: str, headers: dict | None = None):
+        self.url = url
+        self.path = path
+        self.headers = headers
+        self.status_code: int | None = None
+        self.total: int | None = None
+        self.written = 0
+        self.finished = False
+        self.error: Exception | None = None
+        self._changed = asyncio.Condition()
+
+    async def _notify(self):
+        async with self._changed:
+            self._changed.notify_all()
+
+    async def run(self):
+        try:
+            async with httpx.AsyncClient(follow_redirects=True, timeout=DownloadSettings.timeout.value) as client:
+                async with client.stream("GET", self.url, headers=self.headers) as response:
+                    self.status_code = response.status_code
+                    response.raise_for_status()
+                    if response.headers.get("Content-Length", "").isdigit():
+                        self.total = int(response.headers.get("Content-Length"))
+
+                    with open(self.path, "wb") as f:
+                        async for chunk in response.aiter_bytes(DownloadSettings.chunk_size.value):
+                            f.write(chunk)
+                            f.flush()
+                            self.written += len(chunk)
+                            await self._notify()
+        except Exception as e:
+            # Telegram file links have the bot token in their path, so neither the url nor the exception,
+            # that quotes it, gets to the logs
+            self.error = Exception("Download from {:} failed: {:}".format(self.host, _error_description(e)))
+            logging.error(str(self.error))
+        finally:
+            self.finished = True
+            await self._notify()
+
+    async def wait_for(self, written: int):
+        """Waits until at least written bytes are on the disk, or the download is over"""
+        async with self._changed:
+            await self._changed.wait_for(lambda: self.finished or self.written >= written)
+
+    async def wait_until_finished(self):
+        async with self._changed:
+            await self._changed.wait_for(lambda: self.finished)
+
+    async def wait_for_response(self):
+        """Waits until the server answers, returns whether the download goes well so far"""
+        async with self._changed:
+            await self._changed.wait_for(lambda: self.finished or self.status_code is not None)
+        return self.error is None
+
+    @property
+    def host(self) -> str:
+        return httpx.URL(self.url).host
+
+    def raise_for_error(self):
+        if self.error is not None:
+            raise self.error
+
+
+def _to_megabytes(size: int) -> str:
+    return "{:.1f}".format(size / 1024 / 1024)
+
+
+def download_progress_text(download: StreamingDownload) -> str:
+    if download.total is not None:
+        return i18n.t("translation.admin.formatted.download_progress_of_total").format(
+            _to_megabytes(download.written), _to_megabytes(download.total)
+        )
+    return i18n.t("translation.admin.formatted.download_progress").format(_to_megabytes(download.written))
@@ -1,31 +1,183 @@
+import asyncio
 import json
 import os
+import time
 
 import i18n
 import requests
 from telegram import Update
 from telegram.ext import CallbackContext, Application
 
-from .db import read_chat, update_tg_nicknames, read_bid, update_profit_values_by_tg_id, \
-    read_all_users_with_not_null_withdraw_amounts, read_restrictions_for_tg_id
-from .static.const import CommandsWithDescriptions, CommandsRelated, WithdrawCommissions, MinimumWithdrawValues, Other
+from .db import read_chat, read_bid, update_profit_values_by_tg_id, read_all_users_with_not_null_withdraw_amounts, \
+    read_restrictions_for_tg_id, read_chat_with_restrictions, update_chat_fields, update_tg_nicknames, \
+    read_users_by_bids, replace_profit_values_in_bulk, read_all_admins
+from .static.const import CommandsWithDescriptions, CommandsRelated, Other, AdminLevels, CacheTtl
 from .static import formulas
 from .static.formulas import formula_for_total_volume_calculation_before_30_days, \
     formula_for_total_volume_calculation_after_30_days
 
 
-def is_chat_exists(chat_id) -> bool:
-    return True if read_chat(chat_id) is not None else False
+class UpdateContext:
+    """Chat document and restrictions of the chat the update came from.
+    Read once before the handlers, changes are written back once after all of them are done"""
+
+    def __init__(self, chat_id: int):
+        self.chat_id = chat_id
+        self.chat = None
+        self.restrictions = None
+        self.changes = {}
+
+    async def load(self):
+        self.chat, self.restrictions = await read_chat_with_restrictions(self.chat_id)
+
+    def set(self, **fields):
+        if self.chat is not None:
+            self.chat.update(fields)
+        self.changes.update(fields)
+
+    async def flush(self):
+        if self.changes and self.chat is not None:
+            await update_chat_fields(self.chat_id, self.changes)
+        self.changes = {}
+
+
+update_contexts: dict[int, UpdateContext] = {}
+
+
+def _roster_level(admin_level):
+    return admin_level if admin_level is not None and admin_level >= AdminLevels.any_admin.value else None
+
+
+class AdminRoster:
+    """Admins grouped by admin level. Read from the db at startup, then again after CacheTtl.admin_roster seconds,
+    or at once after somebody's admin level is seen to be different from the roster"""
+
+    def __init__(self):
+        self.admins: dict[int, list[dict]] = {}
+        self.levels: dict[int, int] = {}
+        self.loaded_at: float | None = None
+        self._lock = asyncio.Lock()
+
+    async def load(self):
+        admins = {}
+        levels = {}
+        async for admin in await read_all_admins(AdminLevels.any_admin.value):
+            admins.setdefault(admin.get("admin_level"), []).append(
+                {"chat_id": admin.get("chat_id"), "language": admin.get("language")}
+            )
+            levels[admin.get("chat_id")] = admin.get("admin_level")
+        self.admins = admins
+        self.levels = levels
+        self.loaded_at = time.monotonic()
+
+    def invalidate(self):
+        self.loaded_at = None
+
+    def check(self, chat: dict | None):
+        """Admin levels are changed right in the db, so the chats of the updates are compared with the roster"""
+        if chat is None or self.loaded_at is None:
+            return
+        if _roster_level(chat.get("admin_level")) != self.levels.get(chat.get("chat_id")):
+            self.invalidate()
+
+    async def read(self, level: int) -> list[dict]:
+        """Chat ids and languages of the admins with the level or higher"""
+        if self.loaded_at is None or time.monotonic() - self.loaded_at >= CacheTtl.admin_roster.value:
+            async with self._lock:
+                # Another caller could have reloaded it while this one waited
+                if self.loaded_at is None or time.monotonic() - self.loaded_at >= CacheTtl.admin_roster.value:
+                    await self.load()
+
+        return [
+            admin
+            for admin_level, admins in self.admins.items() if admin_level >= level
+            for admin in admins
+        ]
+
+
+admin_roster = AdminRoster()
+
+
+async def load_update_context(update: Update, _: CallbackContext):
+    """Should be registered before all other handlers"""
+    if update.effective_chat is None:
+        return
+    update_context = UpdateContext(update.effective_chat.id)
+    await update_context.load()
+    update_contexts[update.effective_chat.id] = update_context
+    admin_roster.check(update_context.chat)
+
+
+async def flush_update_context(update: Update, _: CallbackContext):
+    """Should be registered after all other handlers"""
+    if update.effective_chat is None:
+        return
+    update_context = update_contexts.pop(update.effective_chat.id, None)
+    if update_context is not None:
+        await update_context.flush()
+
+
+async def get_chat(chat_id: int):
+    """Chat from the current update if there is one, otherwise from the db (jobs, other users)"""
+    update_context = update_contexts.get(chat_id)
+    if update_context is not None:
+        return update_context.chat
+    return await read_chat(chat_id)
+
+
+async def set_chat_fields(chat_id: int, **fields):
+    """Changes are written at the end of the current update if there is one, otherwise right away"""
+    update_context = update_contexts.get(chat_id)
+    if update_context is not None:
+        update_context.set(**fields)
+    else:
+        await update_chat_fields(chat_id, fields)
+
+
+async def is_chat_exists(chat_id) -> bool:
+    return True if await get_chat(chat_id) is not None else False
+
+
+pending_nicknames: dict[int, tuple[str, str]] = {}
 
 
-def main_handler(chat_id, name, user):
+async def main_handler(chat_id, name, user):
     if name is not None and user is not None:
-        update_tg_nicknames(chat_id, name, user)
-    return language_handler(chat_id)
+        chat = await get_chat(chat_id)
+        known_nicknames = pending_nicknames.get(chat_id)
+        if known_nicknames is None and chat is not None:
+            known_nicknames = (chat.get("tg_name"), chat.get("tg_link"))
 
+        # Nicknames are written in bulk by flush_nicknames, and only if they have changed
+        if chat is not None and known_nicknames != (name, user):
+            pending_nicknames[chat_id] = (name, user)
+            chat.update({"tg_name": name, "tg_link": user})
+    return await language_handler(chat_id)
 
-def critical_checks(chat_id: int) -> bool:
-    restrictions = read_restrictions_for_tg_id(chat_id)
+
+async def write_pending_nicknames():
+    if not pending_nicknames:
+        return
+    nicknames = pending_nicknames.copy()
+    pending_nicknames.clear()
+    await update_tg_nicknames(nicknames)
+
+
+async def flush_nicknames(_: CallbackContext):
+    """Repeating job, see FlushIntervals"""
+    await write_pending_nicknames()
+
+
+async def flush_nicknames_on_shutdown(_: Application):
+    await write_pending_nicknames()
+
+
+async def critical_checks(chat_id: int) -> bool:
+    update_context = update_contexts.get(chat_id)
+    if update_context is not None:
+        restrictions = update_context.restrictions
+    else:
+        restrictions = await read_restrictions_for_tg_id(chat_id)
     if chat_id <= 0:
         return False
     elif restrictions is not None and restrictions:
@@ -34,8 +186,8 @@ def critical_checks(chat_id: int) -> bool:
         return True
 
 
-def language_handler(chat_id):
-    chat = read_chat(chat_id)
+async def language_handler(chat_id):
+    chat = await get_chat(chat_id)
     try:
         i18n.set("locale", chat["language"])
     except KeyError:
@@ -54,15 +206,15 @@ def is_chat_private(update: Update, context: CallbackContext) -> bool:
         return False
 
 
-def is_admin(update: Update | int, required_level):
+async def is_admin(update: Update | int, required_level):
     """If you can't get update(from jobs), please, send chat_id in update field"""
     if type(update) == Update:
-        main_handler(
+        await main_handler(
             update.effective_chat.id if type(update) == Update else update,
             update.effective_user.first_name,
             update.effective_user.username
         )
-    chat = read_chat(update.effective_chat.id if type(update) == Update else update)
+    chat = await get_chat(update.effective_chat.id if type(update) == Update else update)
     return (
         True
         if chat.get("admin_level") is not None
@@ -80,180 +232,72 @@ async def generate_command_list(application: Application):
     await application.bot.set_my_commands(command_list)
 
 
-def is_fully_registered(chat_id: int):
-    return True if read_chat(chat_id).get("authorization_time") is not None else False
+async def is_fully_registered(chat_id: int):
+    return True if (await get_chat(chat_id)).get("authorization_time") is not None else False
 
 
-def calculate_cashback_for_user_with_id(sum_from_api: dict, bid: int):
-    user = read_bid(bid)
-    # print(bid, user)
-    # print(sum_from_api)
+async def calculate_cashback_for_user_with_id(sum_from_api: dict, bid: int):
+    user = await read_bid(bid)
 
     if user is None:
         return
 
-    user_level = user.get("user_level", 1)
-
-    """Before goes for before 30 days of using the bot, after goes for after using bot for 30 days. s_ goes for sum"""
-    _before = sum_from_api.get("sum_results_before_user_used_the_bot_for_30_days", {})
-    _after = sum_from_api.get("sum_results_after_user_used_the_bot_for_30_days", {})
-    _spot = "spot"
-    _futures = "futures"
-    _before_spot = _before.get(_spot, {})
-    _before_futures = _before.get(_futures, {})
-    _after_spot = _after.get(_spot, {})
-    _after_futures = _after.get(_futures, {})
-
-    before_spot_usdt = _before_spot.get("usdt", 0.0)
-    before_spot_busd = _before_spot.get("busd", 0.0)
-    before_spot_bnb = _before_spot.get("bnb", 0.0)
-    before_futures_usdt = _before_futures.get("usdt", 0.0)
-    before_futures_busd = _before_futures.get("busd", 0.0)
-    before_futures_bnb = _before_futures.get("bnb", 0.0)
-    after_spot_usdt = _after_spot.get("usdt", 0.0)
-    after_spot_busd = _after_spot.get("busd", 0.0)
-    after_spot_bnb = _after_spot.get("bnb", 0.0)
-    after_futures_usdt = _after_futures.get("usdt", 0.0)
-    after_futures_busd = _after_futures.get("busd", 0.0)
-    after_futures_bnb = _after_futures.get("bnb", 0.0)
-
-    del _before
-    del _after
-    del _spot
-    del _futures
-    del _before_spot
-    del _before_futures
-    del _after_spot
-    del _after_futures
-
-    if user_level == 1:
-        calculated_before_spot_usdt = formulas.level1_spot_less30(before_spot_usdt)
-        calculated_before_spot_busd = formulas.level1_spot_less30(before_spot_busd)
-        calculated_before_spot_bnb = formulas.level1_bnb_less30(before_spot_bnb)
-        calculated_before_futures_usdt = formulas.level1_futures_less30(before_futures_usdt)
-        calculated_before_futures_busd = formulas.level1_futures_less30(before_futures_busd)
-        calculated_before_futures_bnb = formulas.level1_bnb_less30(before_futures_bnb)
-        calculated_after_spot_usdt = formulas.level1_spot_more30(after_spot_usdt)
-        calculated_after_spot_busd = formulas.level1_spot_more30(after_spot_busd)
-        calculated_after_spot_bnb = formulas.level1_bnb_more30(after_spot_bnb)
-        calculated_after_futures_usdt = formulas.level1_futures_more30(after_futures_usdt)
-        calculated_after_futures_busd = formulas.level1_futures_more30(after_futures_busd)
-        calculated_after_futures_bnb = formulas.level1_bnb_more30(after_futures_bnb)
-
-    elif user_level == 2:
-        calculated_before_spot_usdt = formulas.level2_spot_less30(before_spot_usdt)
-        calculated_before_spot_busd = formulas.level2_spot_less30(before_spot_busd)
-        calculated_before_spot_bnb = formulas.level2_bnb_less30(before_spot_bnb)
-        calculated_before_futures_usdt = formulas.level2_futures_less30(before_futures_usdt)
-        calculated_before_futures_busd = formulas.level2_futures_less30(before_futures_busd)
-        calculated_before_futures_bnb = formulas.level2_bnb_less30(before_futures_bnb)
-        calculated_after_spot_usdt = formulas.level2_spot_more30(after_spot_usdt)
-        calculated_after_spot_busd = formulas.level2_spot_more30(after_spot_busd)
-        calculated_after_spot_bnb = formulas.level2_bnb_more30(after_spot_bnb)
-        calculated_after_futures_usdt = formulas.level2_futures_more30(after_futures_usdt)
-        calculated_after_futures_busd = formulas.level2_futures_more30(after_futures_busd)
-        calculated_after_futures_bnb = formulas.level2_bnb_more30(after_futures_bnb)
+    (total_usdt, total_bnb), = formulas.calculate_cashback_for_users([sum_from_api], [user.get("user_level", 1)])
+    await update_profit_values_by_tg_id(user.get("chat_id"), total_usdt, total_bnb)
 
-    else:
-        calculated_before_spot_usdt = 0.0
-        calculated_before_spot_busd = 0.0
-        calculated_before_spot_bnb = 0.0
-        calculated_before_futures_usdt = 0.0
-        calculated_before_futures_busd = 0.0
-        calculated_before_futures_bnb = 0.0
-        calculated_after_spot_usdt = 0.0
-        calculated_after_spot_busd = 0.0
-        calculated_after_spot_bnb = 0.0
-        calculated_after_futures_usdt = 0.0
-        calculated_after_futures_busd = 0.0
-        calculated_after_futures_bnb = 0.0
-
-    del before_spot_usdt
-    del before_spot_busd
-    del before_spot_bnb
-    del before_futures_usdt
-    del before_futures_busd
-    del before_futures_bnb
-    del after_spot_usdt
-    del after_spot_busd
-    del after_spot_bnb
-    del after_futures_usdt
-    del after_futures_busd
-    del after_futures_bnb
-
-    total_usdt = sum(
-        [
-            calculated_after_spot_usdt,
-            calculated_after_futures_usdt,
-            calculated_before_futures_usdt,
-            calculated_before_spot_usdt,
-
-            calculated_before_spot_busd,
-            calculated_before_futures_busd,
-            calculated_after_spot_busd,
-            calculated_after_futures_busd
-        ]
-    )
-    total_bnb = sum(
-        [
-            calculated_after_futures_bnb,
-            calculated_before_futures_bnb,
-            calculated_after_spot_bnb,
-            calculated_before_spot_bnb
-        ]
-    )
 
-    del calculated_before_spot_usdt
-    del calculated_before_spot_busd
-    del calculated_before_spot_bnb
-    del calculated_before_futures_usdt
-    del calculated_before_futures_busd
-    del calculated_before_futures_bnb
-    del calculated_after_spot_usdt
-    del calculated_after_spot_busd
-    del calculated_after_spot_bnb
-    del calculated_after_futures_usdt
-    del calculated_after_futures_busd
-    del calculated_after_futures_bnb
+async def calculate_cashback_for_all_users(calculation_results: dict, calculation_id: str) -> dict:
+    """Same as calculate_cashback_for_user_with_id, but for every bid from the api at once:
+    users are read with one query and written with one bulk write, that also zeroes withdraw values of the users
+    the api has no results for. Returns amounts of updated and skipped bids"""
+    users = {}
+    async for user in await read_users_by_bids([int(bid) for bid in calculation_results]):
+        users.setdefault(user.get("binance_id"), user)
 
-    total_usdt = total_usdt - WithdrawCommissions.usdt_commission.value
-    total_bnb = total_bnb - WithdrawCommissions.bnb_commission.value
+    found_users = []
+    found_sums = []
+    for bid, sum_from_api in calculation_results.items():
+        user = users.get(int(bid))
+        if user is None:
+            continue
+        found_users.append(user)
+        found_sums.append(sum_from_api)
 
-    total_usdt = round(total_usdt, 3)
-    total_bnb = round(total_bnb, 4)
+    cashback = formulas.calculate_cashback_for_users(found_sums, [user.get("user_level", 1) for user in found_users])
+    profit_values = [
+        (user.get("chat_id"), total_usdt, total_bnb) for user, (total_usdt, total_bnb) in zip(found_users, cashback)
+    ]
 
-    if total_usdt < MinimumWithdrawValues.usdt.value:
-        total_usdt = 0.0
-    if total_bnb < MinimumWithdrawValues.bnb.value:
-        total_bnb = 0.0
+    await replace_profit_values_in_bulk(profit_values, calculation_id)
 
-    update_profit_values_by_tg_id(user.get("chat_id"), total_usdt, total_bnb)
+    return {"updated": len(profit_values), "skipped": len(calculation_results) - len(profit_values)}
 
 
-async def generate_list_of_current_withdraws(update: Update, context: CallbackContext):
+async def generate_list_of_current_withdraws(chat_id: int, context: CallbackContext, calculation_results=None):
+    """Takes calculation_results if they are already known, otherwise requests them from the api"""
     string_to_send = i18n.t("translation.admin.withdraw_list")
 
-    api_location = os.getenv("API_LOCATION")
-    if api_location is None:
-        await context.bot.send_message(update.effective_chat.id, i18n.t("translation.wrong_env_config"))
+    if calculation_results is None:
+        api_location = os.getenv("API_LOCATION")
+        if api_location is None:
+            await context.bot.send_message(chat_id, i18n.t("translation.wrong_env_config"))
 
-    # Get calculations from the api
-    cashback_results = requests.get(
-        api_location +
-        "calculations/get_calculation_results_for_all_users/{}?bot_internal_id=" +
-        str(Other.bot_id.value)
-    )
-    if cashback_results.status_code != 200:
-        await context.bot.send_message(
-            update.effective_chat.id,
-            i18n.t("translation.admin.error_during_api_calculations")
+        # Get calculations from the api
+        cashback_results = requests.get(
+            api_location +
+            "calculations/get_calculation_results_for_all_users/{}?bot_internal_id=" +
+            str(Other.bot_id.value)
         )
-        return
+        if cashback_results.status_code != 200:
+            await context.bot.send_message(
+                chat_id,
+                i18n.t("translation.admin.error_during_api_calculations")
+            )
+            return
 
-    # Calculate with ratios for this user, save to the db
-    calculation_results: dict = json.loads(cashback_results.text)
+        calculation_results: dict = json.loads(cashback_results.text)
 
-    for user in read_all_users_with_not_null_withdraw_amounts():
+    async for user in await read_all_users_with_not_null_withdraw_amounts():
         binance_id = str(user.get("binance_id"))
         if binance_id not in calculation_results:
             continue
@@ -0,0 +1,92 @@
+import asyncio
+import logging
+from datetime import datetime, timedelta
+
+from telegram import InlineKeyboardMarkup
+from telegram.ext import CallbackContext
+
+from .broadcasts import Broadcast
+from .db import (
+    claim_outbox_messages,
+    count_outbox_states,
+    interrupt_sending_outbox_messages,
+    update_outbox_message
+)
+from .static.const import OutboxSettings, OutboxStates
+
+
+# Created on the first run of the sender, so the rate limits carry over between runs
+_broadcast: Broadcast | None = None
+_sending = asyncio.Lock()
+
+
+def outbox_message(dedupe_key: str, chat_id: int, text: str, parse_mode: str | None = None,
+                   reply_markup: InlineKeyboardMarkup | None = None) -> dict:
+    """The message is sent only once for the dedupe key, however many times it's added to the outbox"""
+    return {
+        "dedupe_key": dedupe_key,
+        "chat_id": chat_id,
+        "text": text,
+        "parse_mode": parse_mode,
+        "reply_markup": reply_markup.to_dict() if reply_markup is not None else None
+    }
+
+
+async def _deliver(broadcast: Broadcast, message: dict):
+    attempts = message.get("attempts", 0) + 1
+    reply_markup = message.get("reply_markup")
+    try:
+        state = await broadcast.send(
+            message.get("chat_id"),
+            message.get("text"),
+            parse_mode=message.get("parse_mode"),
+            reply_markup=InlineKeyboardMarkup.de_json(reply_markup, broadcast.bot) if reply_markup is not None else None
+        )
+    except Exception as e:
+        logging.error("Failed to send outbox message {:}: {:}".format(message.get("dedupe_key"), e))
+        state = OutboxStates.failed
+
+    fields = {"state": state.value, "attempts": attempts}
+    if state == OutboxStates.pending:
+        if attempts >= OutboxSettings.max_attempts.value:
+            fields["state"] = OutboxStates.failed.value
+        else:
+            fields["next_attempt"] = datetime.now() + timedelta(
+                seconds=OutboxSettings.backoff.value * 2 ** (attempts - 1)
+            )
+    elif state == OutboxStates.sent:
+        fields["sent"] = datetime.now()
+
+    await update_outbox_message(message.get("_id"), fields)
+
+
+async def send_outbox(context: CallbackContext):
+    """Job queue callback. Sends due messages of the outbox batch by batch, until none are left"""
+    global _broadcast
+
+    # The previous run is still going through a long broadcast
+    if _sending.locked():
+        return
+
+    async with _sending:
+        if _broadcast is None:
+            _broadcast = Broadcast(context.bot)
+
+        while batch := await claim_outbox_messages(OutboxSettings.batch_size.value):
+            await asyncio.gather(*[_deliver(_broadcast, message) for message in batch])
+
+
+async def recover_outbox():
+    """Runs before the sender starts. Messages, that were being sent when the bot stopped, aren't sent again"""
+    result = await interrupt_sending_outbox_messages()
+    if result.modified_count >= 1:
+        logging.warning("{:} outbox messages were interrupted by the restart".format(result.modified_count))
+
+
+async def wait_for_outbox_messages(dedupe_keys: list[str]) -> dict[str, int]:
+    """Waits until none of the messages is pending or being sent, returns state -> amount of them"""
+    while True:
+        states = await count_outbox_states(dedupe_keys)
+        if not states.get(OutboxStates.pending.value) and not states.get(OutboxStates.sending.value):
+            return states
+        await asyncio.sleep(OutboxSettings.interval.value)
@@ -35,6 +35,7 @@ class QueryCommands(Enum):
     notify_new_payoff = "nnp"
     increase_level = "il"
     decrease_level = "dl"
+    cancel_calculation = "c_calc"
 
 
 class AdminLevels(Enum):
@@ -97,19 +98,86 @@ class FilechangerLinkRegex(Enum):
     pixel_drain = r"https://pixeldrain.com/u/[a-zA-Z0-9]{3-12}"
 
 
-class CsvColumns(Enum):
-    order_type = "Order Type"
-    friend_id_spot = "Friend's ID(Spot)"
-    friend_id_sub_spot = "Friend's sub ID (Spot)"
-    commission_asset = "Commission Asset"
-    coin_commission_earned = "Commission Earned"
-    usdt_commission_earned = "Commission Earned (USDT)"
-    commission_time = "Commission Time"
-    registration_time = "Registration Time"
-    referral_id = "Referral ID"
+class FlushIntervals(Enum):
+    """Seconds between writes of the changes that are collected in memory"""
+    nicknames = 30
+
+
+class MediaGroupSettings(Enum):
+    # Telegram doesn't say how many parts an album has, but there are never more than 10
+    max_parts = 10
+    # Seconds without a new part, after which the album is considered complete
+    idle_timeout = 1
+
+
+class CacheTtl(Enum):
+    """Seconds before the data that is kept in memory is read from the db again"""
+    admin_roster = 5 * 60
+
+
+class CsvIngestSettings(Enum):
+    # Bytes of the file one worker process parses at once
+    chunk_size = 4 * 1024 * 1024
+
+
+class DownloadSettings(Enum):
+    # Bytes read from the connection at once
+    chunk_size = 256 * 1024
+    # Seconds between edits of the progress message
+    progress_interval = 3
+    # Seconds to wait for the server between chunks
+    timeout = 60
+    # Seconds to wait for the api to write the uploaded file
+    upload_timeout = 30 * 60
+
+
+class BroadcastSettings(Enum):
+    # Telegram lets a bot send about 30 messages a second in total and about 1 a second to the same chat
+    global_rate = 30
+    per_chat_rate = 1
+    # Messages that are being sent at the same moment
+    concurrency = 30
+    # Attempts of one message after flood waits and network errors
+    max_attempts = 5
+    # Seconds before the second attempt after a network error, doubled for every next one
+    backoff = 1
+
+
+class CalculationStages(Enum):
+    queued = "queued"
+    downloading = "downloading"
+    ingesting = "ingesting"
+    calculating = "calculating"
+    cashback = "cashback"
+    withdraw_list = "withdraw_list"
+    finished = "finished"
+    cancelled = "cancelled"
+    failed = "failed"
 
 
 class Other(Enum):
     bot_id = 1
     manual_support = "@cheeeryyygirs"
-    maximum_user_level = 2
+
+
+class OutboxStates(Enum):
+    pending = "pending"
+    sending = "sending"
+    sent = "sent"
+    blocked = "blocked"
+    failed = "failed"
+    # The bot stopped while sending, the message may have been delivered, so it isn't sent again
+    interrupted = "interrupted"
+
+
+class OutboxSettings(Enum):
+    # Seconds between runs of the sender
+    interval = 2
+    # Messages claimed from the db and sent at once
+    batch_size = 30
+    # Attempts of one message after network errors, counted across restarts
+    max_attempts = 5
+    # Seconds before the next attempt, doubled after every failed one
+    backoff = 30
+    # Messages written to the outbox in one bulk write
+    write_batch_size = 1000
@@ -1,3 +1,9 @@
+from typing import NamedTuple
+
+import numpy as np
+
+from .const import MinimumWithdrawValues, WithdrawCommissions
+
 round_arg = 3
 
 
@@ -9,49 +15,130 @@ def formula_for_total_volume_calculation_after_30_days(sum_arg: int | float) ->
     return float(round(sum_arg * 100 / 30, round_arg))
 
 
-def level1_futures_less30(sum_arg: int | float) -> float:
-    return float(round(((sum_arg * 100 / 40) * 25) / 100, round_arg))
-
-
-def level1_futures_more30(sum_arg: int | float) -> float:
-    return float(round(((sum_arg * 100 / 30) * 25) / 100, round_arg))
-
-
-def level1_spot_less30(sum_arg: int | float) -> float:
-    return float(round(((sum_arg * 100 / 41) * 30) / 100, round_arg))
-
-
-def level1_spot_more30(sum_arg: int | float) -> float:
-    return float(round(((sum_arg * 100 / 41) * 30) / 100, round_arg))
-
-
-def level1_bnb_less30(sum_arg: int | float) -> float:
-    return float(((sum_arg * 100 / 41) * 30) / 100)
-
-
-def level1_bnb_more30(sum_arg: int | float) -> float:
-    return float(((sum_arg * 100 / 41) * 30) / 100)
-
-
-def level2_futures_less30(sum_arg: int | float) -> float:
-    return float(round(sum_arg, round_arg))
-
-
-def level2_futures_more30(sum_arg: int | float) -> float:
-    return float(round(sum_arg, round_arg))
-
-
-def level2_spot_less30(sum_arg: int | float) -> float:
-    return float(round(sum_arg, round_arg))
-
-
-def level2_spot_more30(sum_arg: int | float) -> float:
-    return float(round(sum_arg, round_arg))
-
-
-def level2_bnb_less30(sum_arg: int | float) -> float:
-    return float(round(sum_arg, round_arg))
-
-
-def level2_bnb_more30(sum_arg: int | float) -> float:
-    return float(round(sum_arg, round_arg))
+class Rate(NamedTuple):
+    """Cashback is ((sum * 100 / divisor) * percent) / 100, rounded to round_digits.
+    Without divisor the sum is taken as is, without round_digits it isn't rounded"""
+    divisor: int | None
+    percent: int | None
+    round_digits: int | None
+
+
+# Columns of the sums matrix: (before or after 30 days, order type, asset), same keys as in the api response
+SUM_COLUMNS = [
+    (period, order_type, asset)
+    for period in ["before", "after"]
+    for order_type in ["spot", "futures"]
+    for asset in ["usdt", "busd", "bnb"]
+]
+
+_level1_spot = Rate(41, 30, round_arg)
+_level1_futures_before = Rate(40, 25, round_arg)
+_level1_futures_after = Rate(30, 25, round_arg)
+_level1_bnb = Rate(41, 30, None)
+_level2 = Rate(None, None, round_arg)
+
+# User level -> rate for every column of SUM_COLUMNS. Users of levels that aren't here get nothing
+CASHBACK_RATES: dict[int, dict[tuple[str, str, str], Rate]] = {
+    1: {
+        ("before", "spot", "usdt"): _level1_spot,
+        ("before", "spot", "busd"): _level1_spot,
+        ("before", "spot", "bnb"): _level1_bnb,
+        ("before", "futures", "usdt"): _level1_futures_before,
+        ("before", "futures", "busd"): _level1_futures_before,
+        ("before", "futures", "bnb"): _level1_bnb,
+        ("after", "spot", "usdt"): _level1_spot,
+        ("after", "spot", "busd"): _level1_spot,
+        ("after", "spot", "bnb"): _level1_bnb,
+        ("after", "futures", "usdt"): _level1_futures_after,
+        ("after", "futures", "busd"): _level1_futures_after,
+        ("after", "futures", "bnb"): _level1_bnb,
+    },
+    2: {column: _level2 for column in SUM_COLUMNS},
+}
+
+maximum_user_level = max(CASHBACK_RATES)
+
+# Columns that are summed into the totals. The order is the one sums were always added in,
+# floating point addition isn't associative, so changing it may change the last digit of a payout
+USDT_TOTAL_COLUMNS = [
+    ("after", "spot", "usdt"),
+    ("after", "futures", "usdt"),
+    ("before", "futures", "usdt"),
+    ("before", "spot", "usdt"),
+    ("before", "spot", "busd"),
+    ("before", "futures", "busd"),
+    ("after", "spot", "busd"),
+    ("after", "futures", "busd"),
+]
+BNB_TOTAL_COLUMNS = [
+    ("after", "futures", "bnb"),
+    ("before", "futures", "bnb"),
+    ("after", "spot", "bnb"),
+    ("before", "spot", "bnb"),
+]
+
+
+def sums_from_api_to_row(sum_from_api: dict) -> list[float]:
+    """Flattens one user from the api response into a row of the sums matrix"""
+    periods = {
+        "before": sum_from_api.get("sum_results_before_user_used_the_bot_for_30_days", {}),
+        "after": sum_from_api.get("sum_results_after_user_used_the_bot_for_30_days", {}),
+    }
+    return [periods[period].get(order_type, {}).get(asset, 0.0) for period, order_type, asset in SUM_COLUMNS]
+
+
+def _round(values: np.ndarray, digits: int) -> np.ndarray:
+    # np.round isn't correctly rounded (it multiplies by 10 ** digits), python's round is, so results stay the same
+    return np.array([round(value, digits) for value in values.tolist()], dtype=np.float64)
+
+
+def calculate_cashback_for_levels(
+        sums: np.ndarray,
+        user_levels: np.ndarray,
+        commission: float,
+        minimum: float,
+        asset_columns: list[tuple[str, str, str]],
+        total_round_digits: int
+) -> np.ndarray:
+    """Takes sums matrix (a row per user, SUM_COLUMNS as columns) and levels of these users.
+    Returns total of the asset_columns for every user, minus the withdraw commission, and 0 if below minimum"""
+    total = np.zeros(len(sums), dtype=np.float64)
+
+    for level, rates in CASHBACK_RATES.items():
+        rows = user_levels == level
+        if not rows.any():
+            continue
+
+        level_total = np.zeros(int(rows.sum()), dtype=np.float64)
+        for column in asset_columns:
+            rate = rates[column]
+            values = sums[rows, SUM_COLUMNS.index(column)]
+            if rate.divisor is not None:
+                values = ((values * 100 / rate.divisor) * rate.percent) / 100
+            if rate.round_digits is not None:
+                values = _round(values, rate.round_digits)
+            level_total = level_total + values
+
+        total[rows] = level_total
+
+    total = _round(total - commission, total_round_digits)
+    return np.where(total < minimum, 0.0, total)
+
+
+def calculate_cashback_for_users(sums_from_api: list[dict], user_levels: list[int]) -> list[tuple[float, float]]:
+    """Returns (usdt, bnb) available to withdraw for every user, calculated for all of them at once"""
+    sums = np.array([sums_from_api_to_row(sum_from_api) for sum_from_api in sums_from_api], dtype=np.float64)
+    levels = np.array(user_levels)
+
+    total_usdt = calculate_cashback_for_levels(
+        sums, levels,
+        WithdrawCommissions.usdt_commission.value, MinimumWithdrawValues.usdt.value,
+        USDT_TOTAL_COLUMNS, 3
+    )
+    total_bnb = calculate_cashback_for_levels(
+        sums, levels,
+        WithdrawCommissions.bnb_commission.value, MinimumWithdrawValues.bnb.value,
+        BNB_TOTAL_COLUMNS, 4
+    )
+
+    return list(zip(total_usdt.tolist(), total_bnb.tolist()))
@@ -14,18 +14,19 @@ from telegram import (
 from telegram.constants import ParseMode
 from telegram.ext import CallbackContext, ConversationHandler
 
-from .static.const import AdminLevels, QueryCategories, QueryCommands, Other
-from .middleware import is_admin, is_chat_private, main_handler
+from .static.const import AdminLevels, MediaGroupSettings, QueryCategories, QueryCommands, Other
+from .middleware import admin_roster, get_chat, is_admin, is_chat_private, main_handler
+from .outbox import outbox_message
 from .db import (
     add_message_to_the_ticket,
     create_support_ticket,
-    read_all_admins,
     read_chat,
     read_open_tickets,
     read_selected_ticket,
     read_ticket_messages,
     select_support_ticket,
     unselect_all_tickets,
+    write_outbox_messages,
 )
 
 
@@ -34,40 +35,41 @@ class AddMessage:
     context = None
     from_type = None
     user_id = None
+    ticket = None
 
     async def start(self, update: Update, context: CallbackContext):
         try:
-            main_handler(update.effective_chat.id, update.effective_user.first_name, update.effective_user.username)
+            await main_handler(update.effective_chat.id, update.effective_user.first_name, update.effective_user.username)
 
             self.update = update
             self.context = context
             self.from_type = (
                 "support_agent"
-                if is_admin(self.update, AdminLevels.support_level.value)
+                if await is_admin(self.update, AdminLevels.support_level.value)
                 else "user"
             )
             self.user_id = update.effective_chat.id
 
-            if read_selected_ticket(self.user_id, self.from_type) is not None:
-                await self._process_content()
+            self.ticket = await read_selected_ticket(self.user_id, self.from_type)
+            if self.ticket is not None:
+                saved_message = await self._process_content()
+                if saved_message is None:
+                    return
 
                 message = update.effective_message
-                msg_dict = {"from_user": update.message.chat.id}
+                # The relay job gets everything it needs, so it doesn't read anything from the db
+                to_user = self.ticket.get("chat_id" if self.from_type == "support_agent" else "support_agent")
+                msg_dict = {
+                    "from_user": update.message.chat.id,
+                    "from_type": self.from_type,
+                    "message": saved_message,
+                    "ticket": self.ticket,
+                    "to_user": to_user,
+                    "language": await interlocutor_language(self.ticket, self.from_type, to_user),
+                }
 
                 if message.media_group_id:
-                    jobs = context.job_queue.get_jobs_by_name(
-                        str(message.media_group_id)
-                    )
-
-                    if jobs:
-                        jobs[0].data.append(msg_dict)
-                    else:
-                        context.job_queue.run_once(
-                            callback=send_message_to_interlocutor,
-                            when=2,
-                            data=[msg_dict],
-                            name=str(message.media_group_id),
-                        )
+                    media_groups.add(context, str(message.media_group_id), msg_dict)
                 else:
                     context.job_queue.run_once(
                         callback=send_message_to_interlocutor,
@@ -84,23 +86,23 @@ class AddMessage:
 
     async def _process_content(self):
         if self.update.message.text is not None:
-            await self._process_text()
+            return await self._process_text()
         elif self.update.message.animation is not None:
-            await self._process_animation()
+            return await self._process_animation()
         elif self.update.message.video is not None:
-            await self._process_video()
+            return await self._process_video()
         elif self.update.message.document is not None:
-            await self._process_document()
+            return await self._process_document()
         elif self.update.message.voice is not None:
-            await self._process_voice()
+            return await self._process_voice()
         elif self.update.message.video_note is not None:
-            await self._process_video_note()
+            return await self._process_video_note()
         elif self.update.message.audio is not None:
-            await self._process_audio()
+            return await self._process_audio()
         elif self.update.message.photo is not None and self.update.message.photo:
-            await self._process_photo()
+            return await self._process_photo()
         elif self.update.message.sticker is not None:
-            await self._process_sticker()
+            return await self._process_sticker()
         else:
             await self.update.message.reply_text(
                 i18n.t("translation.we_dont_support_this_type_of_message")
@@ -134,10 +136,11 @@ class AddMessage:
         return final
 
     async def _process_text(self):
-        add_message_to_the_ticket(
+        return await add_message_to_the_ticket(
             await self._format_message(self.update.message.text, "text"),
             self.user_id,
             self.from_type,
+            self.ticket,
         )
 
     async def _process_photo(self):
@@ -148,8 +151,8 @@ class AddMessage:
         if self.update.message.caption is not None:
             content["caption"] = self.update.message.caption
 
-        add_message_to_the_ticket(
-            await self._format_message(content, "photo"), self.user_id, self.from_type
+        return await add_message_to_the_ticket(
+            await self._format_message(content, "photo"), self.user_id, self.from_type, self.ticket
         )
 
     async def _process_video(self):
@@ -158,8 +161,8 @@ class AddMessage:
         if self.update.message.caption is not None:
             content["caption"] = self.update.message.caption
 
-        add_message_to_the_ticket(
-            await self._format_message(content, "video"), self.user_id, self.from_type
+        return await add_message_to_the_ticket(
+            await self._format_message(content, "video"), self.user_id, self.from_type, self.ticket
         )
 
     async def _process_document(self):
@@ -168,8 +171,8 @@ class AddMessage:
         if self.update.message.caption is not None:
             content["caption"] = self.update.message.caption
 
-        add_message_to_the_ticket(
-            await self._format_message(content, "document"), self.user_id, self.from_type
+        return await add_message_to_the_ticket(
+            await self._format_message(content, "document"), self.user_id, self.from_type, self.ticket
         )
 
     async def _process_audio(self):
@@ -178,17 +181,18 @@ class AddMessage:
         if self.update.message.caption is not None:
             content["caption"] = self.update.message.caption
 
-        add_message_to_the_ticket(
-            await self._format_message(content, "audio"), self.user_id, self.from_type
+        return await add_message_to_the_ticket(
+            await self._format_message(content, "audio"), self.user_id, self.from_type, self.ticket
         )
 
     async def _process_voice(self):
-        add_message_to_the_ticket(
+        return await add_message_to_the_ticket(
             await self._format_message(
                 {"object_tg_id": self.update.message.voice["file_id"]}, "voice"
             ),
             self.user_id,
             self.from_type,
+            self.ticket,
         )
 
     async def _process_animation(self):
@@ -197,27 +201,29 @@ class AddMessage:
         if self.update.message.caption is not None:
             content["caption"] = self.update.message.caption
 
-        add_message_to_the_ticket(
-            await self._format_message(content, "animation"), self.user_id, self.from_type
+        return await add_message_to_the_ticket(
+            await self._format_message(content, "animation"), self.user_id, self.from_type, self.ticket
         )
 
     async def _process_sticker(self):
-        add_message_to_the_ticket(
+        return await add_message_to_the_ticket(
             await self._format_message(
                 {"object_tg_id": self.update.message.sticker["file_id"]}, "sticker"
             ),
             self.user_id,
             self.from_type,
+            self.ticket,
         )
 
     async def _process_video_note(self):
-        add_message_to_the_ticket(
+        return await add_message_to_the_ticket(
             await self._format_message(
                 {"object_tg_id": self.update.message.video_note["file_id"]},
                 "video_note",
             ),
             self.user_id,
             self.from_type,
+            self.ticket,
         )
 
 
@@ -364,23 +370,23 @@ async def send_all_messages_from_saved(update: Update, context: CallbackContext)
     try:
         from_who = (
             "support_agent"
-            if is_admin(update, AdminLevels.support_level.value)
+            if await is_admin(update, AdminLevels.support_level.value)
             else "user"
         )
 
-        ticket = read_selected_ticket(update.effective_chat.id, from_who)
+        ticket = await read_selected_ticket(update.effective_chat.id, from_who)
         media_group_messages = []
         to_user = ticket.get(
             "support_agent"
-            if is_admin(update, AdminLevels.support_level.value)
+            if await is_admin(update, AdminLevels.support_level.value)
             else "chat_id"
         )
 
-        def send_media_group():
-            send_one_message_from_saved(context, media_group_messages, to_user)
+        async def send_media_group():
+            await send_one_message_from_saved(context, media_group_messages, to_user)
 
         try:
-            for message in read_ticket_messages(update.effective_chat.id, from_who):
+            async for message in await read_ticket_messages(update.effective_chat.id, from_who):
                 if message.get("is_message_type", {}).get("is_media_group") is True:
                     if len(media_group_messages) == 0:
                         media_group_messages.append(message)
@@ -390,33 +396,47 @@ async def send_all_messages_from_saved(update: Update, context: CallbackContext)
                         ].get("media_group_id"):
                             media_group_messages.append(message)
                         else:
-                            send_media_group()
+                            await send_media_group()
                             media_group_messages = [message]
 
                 else:
                     if len(media_group_messages) > 0:
-                        send_media_group()
+                        await send_media_group()
                         media_group_messages = []
 
                     await send_one_message_from_saved(context, message, to_user)
 
         except IndexError:
             if len(media_group_messages) > 0:
-                send_media_group()
+                await send_media_group()
                 media_group_messages = []
     except Exception as e:
         await exception_handler(context, e, update)
 
 
+async def interlocutor_language(ticket: dict, from_type: str, to_user: int):
+    """Users' language is kept in their tickets, support agents' one in the admin roster"""
+    if from_type == "support_agent":
+        if ticket.get("language") is not None:
+            return ticket.get("language")
+    else:
+        for admin in await admin_roster.read(AdminLevels.support_level.value):
+            if admin.get("chat_id") == to_user:
+                return admin.get("language")
+
+    # Tickets, that were created before the language was kept in them
+    return (await read_chat(to_user)).get("language")
+
+
 async def send_message_to_interlocutor(context: CallbackContext):
+    """context.job.data has one saved message, or all the saved messages of one media group,
+    together with the ticket and the recipient"""
     try:
-        from_user = context.job.data[0].get("from_user")
-        is_user_admin = is_admin(from_user, AdminLevels.support_level.value)
-        from_who = "support_agent" if is_user_admin else "user"
-
-        ticket = read_selected_ticket(from_user, from_who)
-        to_user = ticket.get("chat_id" if is_user_admin else "support_agent")
-        lang = read_chat(to_user).get("language")
+        relay = context.job.data[0]
+        ticket = relay.get("ticket")
+        to_user = relay.get("to_user")
+        lang = relay.get("language")
+        is_user_admin = relay.get("from_type") == "support_agent"
 
         if ticket.get("is_selected_by_user") is not True:
             await context.bot.send_message(
@@ -466,36 +486,57 @@ async def send_message_to_interlocutor(context: CallbackContext):
             )
             return
 
-        # If media group
-        message = read_ticket_messages(from_user, from_who, reverse=True)
-        current_message = message.next()
-
-        if current_message.get("is_message_type", {}).get("is_media_group") is True:
-            messages = []
-            media_group_id = current_message.get(
-                "media_group_id"
-            )  # Target media group id
-
-            while (
-                current_message.get("is_message_type", {}).get("is_media_group") is True
-                and current_message.get("media_group_id") == media_group_id
-            ):
-                messages.append(current_message)
-                current_message = message.next()
+        # Parts of a media group may have come in any order
+        messages = sorted(
+            [part.get("message") for part in context.job.data], key=lambda message: message.get("message_id")
+        )
 
+        # If media group
+        if messages[0].get("is_message_type", {}).get("is_media_group") is True:
             await send_one_message_from_saved(
-                context, messages[::-1], to_user, True if is_user_admin else False
+                context, messages, to_user, True if is_user_admin else False
             )
 
         # If not media group
         else:
             await send_one_message_from_saved(
-                context, current_message, to_user, True if is_user_admin else False
+                context, messages[0], to_user, True if is_user_admin else False
             )
     except Exception as e:
         await exception_handler(context, e)
 
 
+class MediaGroupAssembler:
+    """Parts of an album come in separate updates. They are collected in memory, and the album is relayed
+    as soon as it has all MediaGroupSettings.max_parts parts, or no new part has come for idle_timeout seconds"""
+
+    def __init__(self):
+        self.groups: dict[str, list[dict]] = {}
+
+    def add(self, context: CallbackContext, media_group_id: str, part: dict):
+        parts = self.groups.setdefault(media_group_id, [])
+        parts.append(part)
+
+        # Every new part restarts the idle timeout
+        for job in context.job_queue.get_jobs_by_name(media_group_id):
+            job.schedule_removal()
+
+        context.job_queue.run_once(
+            callback=self._flush,
+            when=0 if len(parts) >= MediaGroupSettings.max_parts.value else MediaGroupSettings.idle_timeout.value,
+            data=parts,
+            name=media_group_id,
+        )
+
+    async def _flush(self, context: CallbackContext):
+        # A part, that comes after the flush, starts a new group instead of joining the relayed one
+        if self.groups.pop(context.job.name, None) is not None:
+            await send_message_to_interlocutor(context)
+
+
+media_groups = MediaGroupAssembler()
+
+
 async def exception_handler(context, e, update=None):
     if str(e) == "Forbidden: bot was blocked by the user":
         await context.bot.send_message(
@@ -518,7 +559,7 @@ async def exception_handler(context, e, update=None):
 
 
 async def send_support_keyboard(update: Update, context: CallbackContext):
-    main_handler(update.effective_chat.id, update.effective_user.first_name, update.effective_user.username)
+    await main_handler(update.effective_chat.id, update.effective_user.first_name, update.effective_user.username)
     await context.bot.send_message(
         update.effective_chat.id,
         i18n.t("translation.choose"),
@@ -564,11 +605,11 @@ def create_support_keyboard() -> InlineKeyboardMarkup:
     )
 
 
-def create_my_open_tickets_keyboard(
+async def create_my_open_tickets_keyboard(
     update: Update, _: CallbackContext
 ) -> InlineKeyboardMarkup:
-    main_handler(update.effective_chat.id, update.effective_user.first_name, update.effective_user.username)
-    tickets = [ticket for ticket in read_open_tickets(update.effective_chat.id)]
+    await main_handler(update.effective_chat.id, update.effective_user.first_name, update.effective_user.username)
+    tickets = [ticket async for ticket in await read_open_tickets(update.effective_chat.id)]
 
     if tickets:
         keyboard = [
@@ -614,7 +655,7 @@ class NewTicket:
 
     async def start_handler(self, update: Update, context: CallbackContext):
         if is_chat_private(update, context):
-            main_handler(update.effective_chat.id, update.effective_user.first_name, update.effective_user.username)
+            await main_handler(update.effective_chat.id, update.effective_user.first_name, update.effective_user.username)
             await update.callback_query.answer()
             await context.bot.send_message(
                 chat_id=update.effective_chat.id,
@@ -625,7 +666,7 @@ class NewTicket:
             return ConversationHandler.END
 
     async def finish_handler(self, update: Update, context: CallbackContext):
-        main_handler(update.effective_chat.id, update.effective_user.first_name, update.effective_user.username)
+        await main_handler(update.effective_chat.id, update.effective_user.first_name, update.effective_user.username)
         self.user_data[self.HEADING] = update.message.text
 
         await self._create_ticket(update, context)
@@ -636,7 +677,7 @@ class NewTicket:
         def end_message(key: str):
             context.bot.send_message(chat_id=update.effective_chat.id, text=i18n.t(key))
 
-        main_handler(update.effective_chat.id, update.effective_user.first_name, update.effective_user.username)
+        await main_handler(update.effective_chat.id, update.effective_user.first_name, update.effective_user.username)
         self.user_data = {}
 
         if update.callback_query is not None:
@@ -654,24 +695,25 @@ class NewTicket:
         return ConversationHandler.END
 
     async def _create_ticket(self, update: Update, context: CallbackContext):
-        ticket = create_support_ticket(
+        ticket = await create_support_ticket(
             update.effective_chat.id,
             self.user_data.get(self.HEADING, "None"),
+            (await get_chat(update.effective_chat.id)).get("language"),
         )
 
-        select_support_ticket(ticket.inserted_id, update.effective_chat.id, "user")
+        await select_support_ticket(ticket.inserted_id, update.effective_chat.id, "user")
 
         await context.bot.send_message(
             chat_id=update.effective_chat.id,
             text=i18n.t("translation.your_ticket_was_successfully_created"),
         )
 
-        await notify_admins_about_new_ticket(context, ticket.inserted_id)
+        await notify_admins_about_new_ticket(ticket.inserted_id)
 
 
 async def exit_command(update: Update, _: CallbackContext):
-    main_handler(update.effective_chat.id, update.effective_user.first_name, update.effective_user.username)
-    unselect_results = unselect_all_tickets(update.effective_chat.id, "user")
+    await main_handler(update.effective_chat.id, update.effective_user.first_name, update.effective_user.username)
+    unselect_results = await unselect_all_tickets(update.effective_chat.id, "user")
 
     if unselect_results.modified_count >= 1:
         await update.message.reply_text(i18n.t("translation.success"))
@@ -679,11 +721,12 @@ async def exit_command(update: Update, _: CallbackContext):
         await update.message.reply_text(i18n.t("translation.nothing_happened"))
 
 
-async def notify_admins_about_new_ticket(context: CallbackContext, ticket_id):
-    for admin in read_all_admins(AdminLevels.support_level.value):
-        await context.bot.send_message(
-            chat_id=admin.get("chat_id"),
-            text=i18n.t(
+async def notify_admins_about_new_ticket(ticket_id):
+    await write_outbox_messages([
+        outbox_message(
+            "new_ticket:{:}:{:}".format(admin.get("chat_id"), ticket_id),
+            admin.get("chat_id"),
+            i18n.t(
                 "translation.new_ticket_was_opened", locale=admin.get("language", "en")
             ),
             reply_markup=InlineKeyboardMarkup(
@@ -703,10 +746,12 @@ async def notify_admins_about_new_ticket(context: CallbackContext, ticket_id):
                 ]
             ),
         )
+        for admin in await admin_roster.read(AdminLevels.support_level.value)
+    ])
 
 
 async def query_handler_support(update: Update, context: CallbackContext):
-    main_handler(update.effective_chat.id, update.effective_user.first_name, update.effective_user.username)
+    await main_handler(update.effective_chat.id, update.effective_user.first_name, update.effective_user.username)
     if not is_chat_private(update, context):
         return
 
@@ -749,15 +794,15 @@ async def query_handler_support(update: Update, context: CallbackContext):
     ):
         await update.callback_query.answer(
             i18n.t("translation.success")
-            if select_support_ticket(
+            if (await select_support_ticket(
                 query_with_id[1], update.effective_chat.id, "user"
-            ).modified_count
+            )).modified_count
             >= 1
             else i18n.t("translation.nothing_found")
         )
 
     elif query == QueryCommands.my_open_tickets.value:
-        keyboard = create_my_open_tickets_keyboard(update, context)
+        keyboard = await create_my_open_tickets_keyboard(update, context)
         if keyboard:
             await context.bot.edit_message_text(
                 chat_id=update.effective_chat.id,
@@ -0,0 +1,42 @@
+import asyncio
+import uuid
+
+import httpx
+
+from .compression import file_blocks
+from .static.const import DownloadSettings, Other
+
+
+async def _multipart_body(path: str, boundary: str, download=None, sent: asyncio.Event | None = None):
+    yield (
+        "--{:}\r\n"
+        "Content-Disposition: form-data; name=\"file\"; filename=\"newest.csv\"\r\n"
+        "Content-Type: application/octet-stream\r\n\r\n".format(boundary)
+    ).encode()
+    async for block in file_blocks(path, download):
+        yield block
+    yield "\r\n--{:}--\r\n".format(boundary).encode()
+    # httpx asks for the next block only after it has sent the last one
+    if sent is not None:
+        sent.set()
+
+
+async def upload_csv_file(api_location: str, path: str, incremental: bool = False, download=None,
+                          sent: asyncio.Event | None = None) -> dict:
+    """Streams the file to the api, that writes it to its db. If the file is still being downloaded,
+    its blocks are sent as soon as they arrive. sent is set once the whole file is sent,
+    from then on the api writes it whether the response is waited for or not.
+    Returns amounts of inserted, rejected and skipped rows"""
+    boundary = uuid.uuid4().hex
+    async with httpx.AsyncClient(timeout=DownloadSettings.upload_timeout.value) as client:
+        response = await client.post(
+            api_location +
+            "calculations/upload/{}?bot_internal_id=" +
+            str(Other.bot_id.value) +
+            "&incremental=" +
+            str(incremental).lower(),
+            content=_multipart_body(path, boundary, download, sent),
+            headers={"Content-Type": "multipart/form-data; boundary=" + boundary}
+        )
+    response.raise_for_status()
+    return response.json()
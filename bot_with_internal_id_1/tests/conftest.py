@@ -0,0 +1,7 @@
+import os
+import sys
+
+
+# The bot runs from its own directory, with csv_common next to it, as in the image
+bot_directory = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path[:0] = [bot_directory, os.path.dirname(bot_directory)]
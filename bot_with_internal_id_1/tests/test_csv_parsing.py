@@ -0,0 +1,81 @@
+import asyncio
+import random
+from typing import Iterable
+
+import pytest
+
+from src.csv_parsing import _growing_csv_file_ranges, split_csv_file
+
+
+class GrowingDownload:
+    """Writes the content to the file piece by piece, every time the parser waits for more of it"""
+
+    def __init__(self, path: str, content: bytes, piece_sizes: Iterable[int]):
+        self.path = path
+        self.content = content
+        self.piece_sizes = iter(piece_sizes)
+        self.written = 0
+        self.finished = False
+        open(path, "wb").close()
+
+    async def wait_for(self, written: int):
+        while not self.finished and self.written < written:
+            piece = self.content[self.written:self.written + next(self.piece_sizes)]
+            with open(self.path, "ab") as f:
+                f.write(piece)
+            self.written += len(piece)
+            self.finished = self.written == len(self.content)
+
+    def raise_for_error(self):
+        pass
+
+
+def _csv_content(rng: random.Random, lines: int, trailing_line_break: bool = True) -> bytes:
+    content = b"".join(
+        b'"spot","%d","","USDT","%s","%s","2023-01-02 03:04:05","2023-01-01 00:00:00","%s"\n' % (
+            rng.randint(1, 10 ** 9), b"1" * rng.randint(1, 40), b"2" * rng.randint(1, 40), b"r" * rng.randint(0, 20)
+        )
+        for _ in range(lines)
+    )
+    return content if trailing_line_break else content[:-1]
+
+
+def _assert_round_trip(content: bytes, ranges: list[tuple[int, int]]):
+    assert b"".join(content[start:end] for start, end in ranges) == content
+    for (_, end), (next_start, _) in zip(ranges, ranges[1:]):
+        assert end == next_start
+    for start, end in ranges[:-1]:
+        assert end > start and content[end - 1:end] == b"\n"
+
+
+@pytest.mark.parametrize("chunk_size", [1, 50, 333, 4096, 10 ** 6])
+@pytest.mark.parametrize("trailing_line_break", [True, False])
+def test_split_csv_file_round_trip(tmp_path, chunk_size, trailing_line_break):
+    content = _csv_content(random.Random(chunk_size), 300, trailing_line_break)
+    path = tmp_path / "newest.csv"
+    path.write_bytes(content)
+
+    _assert_round_trip(content, split_csv_file(str(path), chunk_size))
+
+
+@pytest.mark.parametrize("chunk_size", [1, 50, 333, 4096, 10 ** 6])
+@pytest.mark.parametrize("trailing_line_break", [True, False])
+def test_growing_file_ranges_match_split_csv_file(tmp_path, chunk_size, trailing_line_break):
+    rng = random.Random(chunk_size)
+    content = _csv_content(rng, 300, trailing_line_break)
+    path = tmp_path / "newest.csv"
+    download = GrowingDownload(str(path), content, iter(lambda: rng.choice([1, 7, 100, 1000, 5000]), None))
+
+    async def collect():
+        return [file_range async for file_range in _growing_csv_file_ranges(str(path), download, chunk_size)]
+
+    ranges = asyncio.run(collect())
+    assert download.finished
+    _assert_round_trip(content, ranges)
+    assert ranges == split_csv_file(str(path), chunk_size)
+
+
+def test_empty_file(tmp_path):
+    path = tmp_path / "newest.csv"
+    path.write_bytes(b"")
+    assert split_csv_file(str(path)) == []
@@ -0,0 +1,150 @@
+import itertools
+import random
+
+import pytest
+
+from src.static import formulas
+from src.static.const import MinimumWithdrawValues, WithdrawCommissions
+
+
+# The per-user formulas the rate table replaced, kept as they were to compare against
+def _level1_futures_less30(sum_arg):
+    return float(round(((sum_arg * 100 / 40) * 25) / 100, 3))
+
+
+def _level1_futures_more30(sum_arg):
+    return float(round(((sum_arg * 100 / 30) * 25) / 100, 3))
+
+
+def _level1_spot(sum_arg):
+    return float(round(((sum_arg * 100 / 41) * 30) / 100, 3))
+
+
+def _level1_bnb(sum_arg):
+    return float(((sum_arg * 100 / 41) * 30) / 100)
+
+
+def _level2(sum_arg):
+    return float(round(sum_arg, 3))
+
+
+def _zero(sum_arg):
+    return 0.0
+
+
+BASELINE_FORMULAS = {
+    1: {
+        ("before", "spot", "usdt"): _level1_spot,
+        ("before", "spot", "busd"): _level1_spot,
+        ("before", "spot", "bnb"): _level1_bnb,
+        ("before", "futures", "usdt"): _level1_futures_less30,
+        ("before", "futures", "busd"): _level1_futures_less30,
+        ("before", "futures", "bnb"): _level1_bnb,
+        ("after", "spot", "usdt"): _level1_spot,
+        ("after", "spot", "busd"): _level1_spot,
+        ("after", "spot", "bnb"): _level1_bnb,
+        ("after", "futures", "usdt"): _level1_futures_more30,
+        ("after", "futures", "busd"): _level1_futures_more30,
+        ("after", "futures", "bnb"): _level1_bnb,
+    },
+    2: {column: _level2 for column in formulas.SUM_COLUMNS},
+}
+
+
+def baseline_cashback(sum_from_api: dict, user_level: int) -> tuple[float, float]:
+    """calculate_cashback_for_user_with_id before the rate table, without the db"""
+    level_formulas = BASELINE_FORMULAS.get(user_level, {column: _zero for column in formulas.SUM_COLUMNS})
+    sums = dict(zip(formulas.SUM_COLUMNS, formulas.sums_from_api_to_row(sum_from_api)))
+    calculated = {column: level_formulas[column](value) for column, value in sums.items()}
+
+    total_usdt = sum([
+        calculated[("after", "spot", "usdt")],
+        calculated[("after", "futures", "usdt")],
+        calculated[("before", "futures", "usdt")],
+        calculated[("before", "spot", "usdt")],
+
+        calculated[("before", "spot", "busd")],
+        calculated[("before", "futures", "busd")],
+        calculated[("after", "spot", "busd")],
+        calculated[("after", "futures", "busd")]
+    ])
+    total_bnb = sum([
+        calculated[("after", "futures", "bnb")],
+        calculated[("before", "futures", "bnb")],
+        calculated[("after", "spot", "bnb")],
+        calculated[("before", "spot", "bnb")]
+    ])
+
+    total_usdt = round(total_usdt - WithdrawCommissions.usdt_commission.value, 3)
+    total_bnb = round(total_bnb - WithdrawCommissions.bnb_commission.value, 4)
+
+    if total_usdt < MinimumWithdrawValues.usdt.value:
+        total_usdt = 0.0
+    if total_bnb < MinimumWithdrawValues.bnb.value:
+        total_bnb = 0.0
+
+    return total_usdt, total_bnb
+
+
+def sum_from_api(values: dict[tuple[str, str, str], float]) -> dict:
+    result = {
+        "sum_results_before_user_used_the_bot_for_30_days": {},
+        "sum_results_after_user_used_the_bot_for_30_days": {},
+    }
+    for (period, order_type, asset), value in values.items():
+        result[f"sum_results_{period}_user_used_the_bot_for_30_days"].setdefault(order_type, {})[asset] = value
+    return result
+
+
+LEVELS = [0, 1, 2, 3]
+
+
+def _random_sums(rng: random.Random) -> dict:
+    columns = rng.sample(formulas.SUM_COLUMNS, rng.randint(0, len(formulas.SUM_COLUMNS)))
+    return sum_from_api({column: rng.choice([
+        rng.uniform(0, 50),
+        rng.uniform(0, 0.05),
+        round(rng.uniform(0, 500), rng.randint(0, 8)),
+    ]) for column in columns})
+
+
+def _threshold_sums() -> list[dict]:
+    """Sums that put one total right around the withdraw commission plus the minimum, or on a rounding half"""
+    usdt_edge = WithdrawCommissions.usdt_commission.value + MinimumWithdrawValues.usdt.value
+    bnb_edge = WithdrawCommissions.bnb_commission.value + MinimumWithdrawValues.bnb.value
+    cases = []
+    for offset in [-0.0015, -0.0005, -0.0001, 0.0, 0.0001, 0.0005, 0.0015]:
+        # Level 2 takes sums as they are, level 1 takes 30/41 of spot and bnb
+        for value in [usdt_edge + offset, (usdt_edge + offset) * 41 / 30]:
+            cases.append(sum_from_api({("before", "spot", "usdt"): value}))
+            cases.append(sum_from_api({("after", "futures", "busd"): value}))
+        for value in [bnb_edge + offset / 10, (bnb_edge + offset / 10) * 41 / 30]:
+            cases.append(sum_from_api({("after", "spot", "bnb"): value}))
+    for value in [0.0005, 0.0015, 1.0005, 2.0005, 2.9995, 3.0005, 1.00005, 0.01505]:
+        cases.append(sum_from_api({column: value for column in formulas.SUM_COLUMNS}))
+    return cases
+
+
+@pytest.mark.parametrize("user_level", LEVELS)
+def test_rate_table_matches_baseline_formulas_on_thresholds(user_level):
+    sums = _threshold_sums()
+    calculated = formulas.calculate_cashback_for_users(sums, [user_level] * len(sums))
+    assert calculated == [baseline_cashback(user_sums, user_level) for user_sums in sums]
+
+
+def test_rate_table_matches_baseline_formulas_for_mixed_levels():
+    rng = random.Random(11)
+    sums = [_random_sums(rng) for _ in range(2000)]
+    levels = [rng.choice(LEVELS) for _ in sums]
+    calculated = formulas.calculate_cashback_for_users(sums, levels)
+    assert calculated == [baseline_cashback(user_sums, level) for user_sums, level in zip(sums, levels)]
+
+
+def test_every_level_and_column_is_covered():
+    for user_level, column in itertools.product(formulas.CASHBACK_RATES, formulas.SUM_COLUMNS):
+        assert column in formulas.CASHBACK_RATES[user_level]
+    assert formulas.maximum_user_level == max(BASELINE_FORMULAS)
+
+
+def test_no_users():
+    assert formulas.calculate_cashback_for_users([], []) == []
@@ -0,0 +1,47 @@
+import zlib
+
+
+MAGIC_NUMBERS = {
+    b"\x1f\x8b": "gzip",
+    b"PK\x03\x04": "zip",
+    b"\x28\xb5\x2f\xfd": "zstd",
+}
+
+
+def detect_compression(first_bytes: bytes) -> str | None:
+    """gzip, zip or zstd, None for the plain .csv"""
+    for magic_number, compression in MAGIC_NUMBERS.items():
+        if first_bytes.startswith(magic_number):
+            return compression
+    return None
+
+
+class GzipDecompressor:
+    """Files glued from several gzip members are valid gzip too, every member needs a new decompressor"""
+
+    def __init__(self):
+        self.decompressor = zlib.decompressobj(wbits=zlib.MAX_WBITS | 16)
+        self.member_started = False
+
+    @property
+    def eof(self) -> bool:
+        """The file ended on a member boundary, not in the middle of a member"""
+        return not self.member_started
+
+    def decompress(self, data: bytes) -> bytes:
+        decompressed = []
+        while data:
+            self.member_started = True
+            decompressed.append(self.decompressor.decompress(data))
+            if not self.decompressor.eof:
+                break
+            data = self.decompressor.unused_data
+            self.decompressor = zlib.decompressobj(wbits=zlib.MAX_WBITS | 16)
+            self.member_started = False
+        return b"".join(decompressed)
+
+
+def raise_if_truncated(decompressor):
+    """Call after the last block, otherwise a cut off upload would pass as a shorter file"""
+    if not decompressor.eof:
+        raise Exception("The archive is truncated")
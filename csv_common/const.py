@@ -22,3 +22,8 @@ class CsvColumns(Enum):
     commission_time = "Commission Time"
     registration_time = "Registration Time"
     referral_id = "Referral ID"
+
+
+class CsvParsingSettings(Enum):
+    # Distinct timestamps kept parsed, per process
+    timestamp_cache_size = 2 ** 16
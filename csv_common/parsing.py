@@ -0,0 +1,77 @@
+import os
+from datetime import datetime, timedelta
+from functools import lru_cache
+
+from .const import CommissionAsset, CsvColumns, CsvParsingSettings, OrderType
+
+
+def _parse_timestamp(value: str) -> datetime:
+    """Parses "YYYY-MM-DD HH:MM:SS" by positions, it's many times faster than strptime with the same format"""
+    if len(value) != 19 or value[4] != "-" or value[7] != "-" or value[10] != " " or value[13] != ":" \
+            or value[16] != ":":
+        raise ValueError("Malformed timestamp {:}".format(value))
+    return datetime(
+        int(value[0:4]), int(value[5:7]), int(value[8:10]), int(value[11:13]), int(value[14:16]), int(value[17:19])
+    )
+
+
+# Registration time is the same in every row of a friend, commission times repeat a lot too,
+# so most of the rows don't need parsing at all
+parse_timestamp = lru_cache(maxsize=CsvParsingSettings.timestamp_cache_size.value)(_parse_timestamp)
+
+
+@lru_cache(maxsize=CsvParsingSettings.timestamp_cache_size.value)
+def trial_end_for_registration(registration_time: str) -> datetime:
+    """Computed once per friend, as long as the friend is in the cache"""
+    return parse_timestamp(registration_time) + timedelta(30)
+
+
+def parse_csv_row(bot_internal_id: int, row: str):
+    """Turns one line of the referral .csv into a csv_cache document.
+    Returns None for blank lines and the header, raises ValueError for rows that can't be parsed"""
+    line_elements: list = row.rstrip("\n").split(",")
+    if len(line_elements) <= 1:
+        return
+    # [1:-1:] To delete ""
+    if line_elements[1][1:-1:] == CsvColumns.friend_id_spot.value:
+        return
+    if line_elements[1][1:-1:].isdigit() is not True or len(line_elements) < 9:
+        raise ValueError("Malformed csv row")
+
+    registration_time = line_elements[7][1:-1:]
+    return {
+        CsvColumns.order_type.value: line_elements[0][1:-1:],
+        CsvColumns.friend_id_spot.value: int(line_elements[1][1:-1:]),
+        CsvColumns.friend_id_sub_spot.value: line_elements[2][1:-1:],
+        CsvColumns.commission_asset.value: line_elements[3][1:-1:],
+        CsvColumns.coin_commission_earned.value: float(line_elements[4][1:-1:]),
+        CsvColumns.usdt_commission_earned.value: float(line_elements[5][1:-1:]),
+        CsvColumns.commission_time.value: parse_timestamp(line_elements[6][1:-1:]),
+        CsvColumns.registration_time.value: parse_timestamp(registration_time),
+        CsvColumns.referral_id.value: str(line_elements[8][1:-1:]),
+        "Internal ID": bot_internal_id,
+        "Date of trial end": trial_end_for_registration(registration_time)
+    }
+
+
+ORDER_TYPE_KEYS = {
+    OrderType.spot.value: "spot",
+    OrderType.usdt_futures.value: "futures",
+}
+
+# USDT is summed by its USDT value, other assets by the amount of the coin itself
+COMMISSION_ASSET_COLUMNS = {
+    CommissionAsset.usdt.value: ("usdt", CsvColumns.usdt_commission_earned.value),
+    CommissionAsset.busd.value: ("busd", CsvColumns.coin_commission_earned.value),
+    CommissionAsset.bnb.value: ("bnb", CsvColumns.coin_commission_earned.value),
+}
+
+
+def csv_parse_workers() -> int:
+    """Amount of processes the .csv is parsed with, CSV_PARSE_WORKERS or the amount of cores the process may use"""
+    workers = os.getenv("CSV_PARSE_WORKERS")
+    if workers is not None and workers.isdigit() and int(workers) > 0:
+        return int(workers)
+    if hasattr(os, "sched_getaffinity"):
+        return len(os.sched_getaffinity(0))
+    return os.cpu_count() or 1